@@ -0,0 +1,39 @@
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+
+class LexicalFilter:
+    """
+    Cheap stage before the FNC cascade: a headline whose TF-IDF cosine similarity with its body is
+    below `threshold` shares almost no content words with it, so the pair is taken as unrelated
+    without running the models. Only the other pairs go on to the first stage model.
+
+    The IDF weights are fitted on the headlines and distinct bodies given to `fit`, or on the ones
+    being filtered when the filter was not fitted.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.vectorizer = None
+
+    def fit(self, headlines, bodies):
+        self.vectorizer = TfidfVectorizer(stop_words='english', sublinear_tf=True)
+        self.vectorizer.fit(list(headlines) + list(dict.fromkeys(bodies)))
+        return self
+
+    def similarity(self, headlines, bodies):
+        """Cosine similarity between the TF-IDF vectors of each headline and its body."""
+        if self.vectorizer is None:
+            self.fit(headlines, bodies)
+        # Bodies are shared by many headlines, so each distinct body is vectorized once
+        body_index = {}
+        inverse = np.fromiter((body_index.setdefault(body, len(body_index)) for body in bodies), dtype=np.int64,
+                              count=len(bodies))
+        body_vectors = self.vectorizer.transform(list(body_index))[inverse]
+        headline_vectors = self.vectorizer.transform(headlines)
+        # The TF-IDF vectors are L2 normalized, so their dot product is the cosine
+        return np.asarray(headline_vectors.multiply(body_vectors).sum(axis=1)).ravel()
+
+    def is_unrelated(self, headlines, bodies):
+        """Boolean mask of the pairs taken as unrelated."""
+        return self.similarity(headlines, bodies) < self.threshold
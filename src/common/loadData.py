@@ -1,36 +1,140 @@
 import os
 from common.reader import JSONLineReader
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+try:
+    import pyarrow as pa
 
-def load_data(file, feature_name, map_value, type_dataset, type_classify):
-    jsonlReader = JSONLineReader()
-    datas = jsonlReader.read(os.getcwd() + file)
-    df_in = pd.DataFrame(datas)
-    headlines = []
-    bodies = []
-    labels = []
-    real_labels = []
-    features = []
-    if type_classify == 'stance':
-        df_in = df_in[df_in['label'] != 'unrelated']
-    for index, row in tqdm(df_in.iterrows(), total=len(df_in), desc=f"Load {type_dataset} set"):
-        headlines.append(row['sentence1'])
-        body_text = ''
-        for value in row['sentences2']:
-           body_text += value + ' '
-        bodies.append(body_text)
-        labels.append(map_value[row['label']])
-        real_labels.append(row['label'])
-        list_feature = []
-        for value in feature_name:
-            list_feature.append(row[value])
-        features.append(list_feature)
-    if len(features[0]) == 0:
+    pyarrow_available = True
+except ImportError:
+    pyarrow_available = False
+
+COLUMNAR_SUFFIX = '.arrow'
+BASE_COLUMNS = ['sentence1', 'sentences2', 'label']
+
+
+def iter_data(file, feature_name, map_value, type_dataset, type_classify, chunk_size=10000, body_table=None,
+              columnar_cache=False, decode_processes=1):
+    """
+    Yields the dataset as text_a/text_b/labels/features frames of at most chunk_size rows.
+
+    Bodies shared by several headlines are interned through body_table (a list of unique
+    bodies, filled while reading) so that every row of the same body references one string,
+    and each frame gets a body_id column indexing into body_table.
+
+    With columnar_cache the JSONL file is converted once to an Arrow file next to it, which is
+    then memory mapped and only the columns used here are read. decode_processes > 1 decodes the
+    JSONL file in parallel (see JSONLineReader).
+    """
+    if body_table is None:
+        body_table = []
+    body_ids = {body: body_id for body_id, body in enumerate(body_table)}
+    if columnar_cache:
+        records = iter_columnar(get_columnar_file(os.getcwd() + file, chunk_size, decode_processes),
+                                BASE_COLUMNS + list(feature_name), chunk_size)
+    else:
+        jsonlReader = JSONLineReader(process_count=decode_processes)
+        records = (pd.DataFrame(datas) for datas in jsonlReader.chunks(os.getcwd() + file, chunk_size))
+    progress = tqdm(desc=f"Load {type_dataset} set", unit=' rows')
+    for df_in in records:
+        progress.update(len(df_in))
+        if type_classify == 'stance':
+            df_in = df_in[df_in['label'] != 'unrelated']
+        if len(df_in) == 0:
+            continue
+        df = process_chunk(df_in, feature_name, map_value)
+        intern_bodies(df, body_ids, body_table)
+        yield df
+    progress.close()
+
+
+def process_chunk(df_in, feature_name, map_value):
+    sentences2 = df_in['sentences2']
+    bodies = sentences2.str.join(' ').add(' ').where(sentences2.str.len() > 0, '')
+    labels = df_in['label'].map(map_value)
+    if labels.isna().any():
+        raise KeyError(f"Labels not in map_value: {sorted(df_in['label'][labels.isna()].unique())}")
+    if len(feature_name) == 0:
         features = [0] * len(df_in)
+    else:
+        features = list(df_in[list(feature_name)].to_numpy(dtype=np.float32))
+
+    return pd.DataFrame({
+        'text_a': df_in['sentence1'].to_numpy(),
+        'text_b': bodies.to_numpy(),
+        'labels': labels.to_numpy(dtype=np.int64),
+        'features': features,
+    })
+
+
+def intern_bodies(df, body_ids, body_table):
+    ids = np.empty(len(df), dtype=np.int64)
+    bodies = []
+    for i, body in enumerate(df['text_b']):
+        body_id = body_ids.get(body)
+        if body_id is None:
+            body_id = len(body_table)
+            body_ids[body] = body_id
+            body_table.append(body)
+        ids[i] = body_id
+        bodies.append(body_table[body_id])
+    df['text_b'] = bodies
+    df['body_id'] = ids
+
+
+def export_columnar(file, output_file, chunk_size=10000, decode_processes=1):
+    """Converts a JSONL file to an uncompressed Arrow IPC file, which can be memory mapped."""
+    if not pyarrow_available:
+        raise ImportError("pyarrow is required to use the columnar dataset format. Install it with pip install pyarrow")
+    writer = None
+    schema = None
+    tmp_file = output_file + '.tmp'
+    try:
+        for datas in JSONLineReader(process_count=decode_processes).chunks(file, chunk_size):
+            if writer is None:
+                table = pa.Table.from_pylist(datas)
+                schema = table.schema
+                writer = pa.ipc.new_file(tmp_file, schema)
+            else:
+                table = pa.Table.from_pylist(datas, schema=schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f"{file} has no records")
+    os.replace(tmp_file, output_file)
+
+
+def get_columnar_file(file, chunk_size=10000, decode_processes=1):
+    """Returns the Arrow file of a JSONL file, exporting it first if it is missing or outdated."""
+    columnar_file = file + COLUMNAR_SUFFIX
+    if not os.path.exists(columnar_file) or os.path.getmtime(columnar_file) < os.path.getmtime(file):
+        export_columnar(file, columnar_file, chunk_size, decode_processes)
+    return columnar_file
+
+
+def iter_columnar(columnar_file, columns, chunk_size=10000):
+    """Yields frames of at most chunk_size rows with the requested columns of a memory mapped Arrow file."""
+    if not pyarrow_available:
+        raise ImportError("pyarrow is required to use the columnar dataset format. Install it with pip install pyarrow")
+    with pa.memory_map(columnar_file, 'r') as source:
+        table = pa.ipc.open_file(source).read_all().select(columns)
+        for batch in table.to_batches(max_chunksize=chunk_size):
+            yield batch.to_pandas()
+
 
-    list_of_tuples = list(zip(headlines, bodies, labels, features))
-    df = pd.DataFrame(list_of_tuples, columns=['text_a', 'text_b', 'labels', 'features'])
+def load_data(file, feature_name, map_value, type_dataset, type_classify, chunk_size=10000, return_bodies=False,
+              columnar_cache=False, decode_processes=1):
+    body_table = []
+    chunks = list(iter_data(file, feature_name, map_value, type_dataset, type_classify, chunk_size, body_table,
+                            columnar_cache, decode_processes))
+    df = pd.concat(chunks, ignore_index=True)
     print(df['labels'].value_counts())
-    return df
\ No newline at end of file
+    if return_bodies:
+        df_bodies = pd.DataFrame({'text_b': body_table})
+        df_bodies.index.name = 'body_id'
+        return df, df_bodies
+    return df
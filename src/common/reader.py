@@ -1,5 +1,14 @@
 import csv
 import json
+import os
+from multiprocessing import Pool, cpu_count
+
+try:
+    import orjson
+
+    orjson_available = True
+except ImportError:
+    orjson_available = False
 
 
 class Reader:
@@ -25,9 +34,76 @@ class JSONReader(Reader):
 
 
 class JSONLineReader(Reader):
+    def __init__(self,encoding="utf-8",process_count=1,block_size=8 * 1024 * 1024):
+        """
+        process_count > 1 decodes the file in parallel: it is split in blocks of about block_size
+        bytes ending on a newline, which are decoded in a process pool (with orjson when installed)
+        and returned in file order.
+        """
+        super().__init__(encoding)
+        self.process_count = process_count if process_count != -1 else max(cpu_count() - 2, 1)
+        self.block_size = block_size
+
+    def read(self,file):
+        if self.process_count > 1:
+            return list(self.stream(file))
+        return super().read(file)
+
     def process(self,fp):
-        data = []
-        for line in fp.readlines():
-            data.append(json.loads(line.strip()))
-        return data
+        return list(self.iter_records(fp))
+
+    def iter_records(self,fp):
+        for line in fp:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    def stream(self,file):
+        """Yields the records of a JSONL file one at a time without loading the whole file."""
+        if self.process_count > 1:
+            yield from self._stream_parallel(file)
+            return
+        with open(file,"r",encoding = self.enc) as f:
+            yield from self.iter_records(f)
+
+    def chunks(self,file,chunk_size):
+        """Yields lists of at most chunk_size records of a JSONL file."""
+        chunk = []
+        for record in self.stream(file):
+            chunk.append(record)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _stream_parallel(self,file):
+        blocks = [(file, start, end, self.enc) for start, end in self.byte_ranges(file)]
+        with Pool(min(self.process_count, max(len(blocks), 1))) as p:
+            for records in p.imap(_decode_block, blocks):
+                yield from records
+
+    def byte_ranges(self,file):
+        """Splits a file in (start, end) byte ranges of about block_size bytes ending on a newline."""
+        size = os.path.getsize(file)
+        ranges = []
+        with open(file,"rb") as f:
+            start = 0
+            while start < size:
+                f.seek(min(start + self.block_size, size))
+                f.readline()
+                end = min(f.tell(), size)
+                ranges.append((start, end))
+                start = end
+        return ranges
+
 
+def _decode_block(block):
+    file, start, end, encoding = block
+    with open(file,"rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if orjson_available and encoding.lower().replace("-", "") == "utf8":
+        return [orjson.loads(line) for line in data.splitlines() if line.strip()]
+    # str.splitlines() would also split on U+0085, U+2028 and U+2029, which JSON strings may contain
+    return [json.loads(line) for line in data.decode(encoding).split("\n") if line.strip()]
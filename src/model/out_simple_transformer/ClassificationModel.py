@@ -4,6 +4,7 @@ import os
 import random
 import warnings
 from dataclasses import asdict
+from functools import partial
 import numpy as np
 from scipy.stats import mode, pearsonr
 from sklearn.metrics import (
@@ -16,9 +17,20 @@ import pandas as pd
 import torch
 
 from model.out_simple_transformer.classification_utils import (
+    BucketBatchSampler,
+    FeatureArrays,
+    FeatureDataset,
     InputExample,
     LazyClassificationDataset,
+    OnnxExportModule,
+    OrderedBatchSampler,
+    OutputArrays,
+    clean_feature_cache,
     convert_examples_to_features,
+    create_conversion_pool,
+    split_into_shards,
+    supports_fast_conversion,
+    tokenizer_fingerprint,
 )
 
 
@@ -33,34 +45,48 @@ from simpletransformers.classification.transformer_models.xlnet_model import XLN
 from simpletransformers.config.model_args import ClassificationArgs
 from simpletransformers.custom_models.models import ElectraForSequenceClassification
 from tensorboardX import SummaryWriter
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from model.roberta.RobertaForSequenceClassification import RobertaForSequenceClassification
 from transformers import (
     WEIGHTS_NAME,
     AdamW,
     AlbertConfig,
     AlbertTokenizer,
+    AlbertTokenizerFast,
     BertConfig,
     BertTokenizer,
+    BertTokenizerFast,
     CamembertConfig,
     CamembertTokenizer,
+    CamembertTokenizerFast,
     DistilBertConfig,
     DistilBertTokenizer,
+    DistilBertTokenizerFast,
     ElectraConfig,
     ElectraTokenizer,
+    ElectraTokenizerFast,
     FlaubertConfig,
     FlaubertTokenizer,
     RobertaConfig,
     RobertaTokenizer,
+    RobertaTokenizerFast,
     XLMConfig,
     XLMRobertaConfig,
     XLMRobertaTokenizer,
+    XLMRobertaTokenizerFast,
     XLMTokenizer,
     XLNetConfig,
     XLNetTokenizer,
     get_linear_schedule_with_warmup,
 )
 
+try:
+    import onnxruntime
+
+    onnxruntime_available = True
+except ImportError:
+    onnxruntime_available = False
+
 try:
     import wandb
 
@@ -70,6 +96,24 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Options used by this project on top of simpletransformers' ClassificationArgs.
+EXTRA_ARGS_DEFAULTS = {
+    "deduplicate_text_b": True,
+    "use_fast_tokenizer": False,
+    "fast_tokenizer_batch_size": 1000,
+    "budgeted_tokenization": True,
+    "cache_shard_size": 10000,
+    "dynamic_padding": True,
+    "bucket_size_multiplier": 100,
+    "max_tokens_per_batch": None,
+    "sort_by_length": True,
+    "outputs_dir": None,
+    "hidden_states_layers": None,
+    "hidden_states_cls_only": False,
+    "keep_model_on_device": False,
+    "onnx_model_path": None,
+}
+
 
 class ClassificationModel():
     def __init__(
@@ -103,6 +147,15 @@ class ClassificationModel():
             "electra": (ElectraConfig, ElectraForSequenceClassification, ElectraTokenizer)
 
         }
+        FAST_TOKENIZER_CLASSES = {
+            "bert": BertTokenizerFast,
+            "roberta": RobertaTokenizerFast,
+            "distilbert": DistilBertTokenizerFast,
+            "albert": AlbertTokenizerFast,
+            "camembert": CamembertTokenizerFast,
+            "xlmroberta": XLMRobertaTokenizerFast,
+            "electra": ElectraTokenizerFast,
+        }
         if model_dir:
             self.args = self._load_model_args(model_dir)
             self.args.labels_list={}
@@ -119,6 +172,10 @@ class ClassificationModel():
         elif isinstance(args, ClassificationArgs):
             self.args = args
 
+        for key, value in EXTRA_ARGS_DEFAULTS.items():
+            if not hasattr(self.args, key):
+                setattr(self.args, key, value)
+
         if "sweep_config" in kwargs:
             sweep_config = kwargs.pop("sweep_config")
 
@@ -153,6 +210,8 @@ class ClassificationModel():
             self.args.labels_list = [i for i in range(len_labels_list)]
 
         config_class, model_class, tokenizer_class = MODEL_CLASSES[model_type]
+        if self.args.use_fast_tokenizer and model_type in FAST_TOKENIZER_CLASSES:
+            tokenizer_class = FAST_TOKENIZER_CLASSES[model_type]
         if num_labels:
             self.config = config_class.from_pretrained(model_load, num_labels=num_labels, **self.args.config)
             self.num_labels = num_labels
@@ -186,11 +245,16 @@ class ClassificationModel():
             self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
 
         self.results = {}
+        self._conversion_pool = None
+        self._model_on_device = False
+        self._onnx_session = None
 
         if not use_cuda:
             self.args.fp16 = False
 
         self.tokenizer = tokenizer_class.from_pretrained(model_name, do_lower_case=self.args.do_lower_case, **kwargs)
+        # Computed before any encoding changes the state of the tokenizer
+        self._tokenizer_fingerprint = tokenizer_fingerprint(self.tokenizer)
 
         self.args.model_name = model_name
         self.args.model_type = model_type
@@ -286,14 +350,31 @@ class ClassificationModel():
                 ]
             train_dataset = self.load_and_cache_examples(train_examples, verbose=verbose)
 
-        train_sampler = RandomSampler(train_dataset)
-
-        train_dataloader = DataLoader(
-            train_dataset,
-            sampler=train_sampler,
-            batch_size=self.args.train_batch_size,
-            num_workers=self.args.dataloader_num_workers,
-        )
+        if isinstance(train_dataset, FeatureDataset) and (
+                self.args.bucket_size_multiplier or self.args.max_tokens_per_batch
+        ):
+            train_batch_sampler = BucketBatchSampler(
+                train_dataset.lengths,
+                self.args.train_batch_size,
+                self.args.bucket_size_multiplier,
+                max_tokens=self.args.max_tokens_per_batch,
+            )
+            train_dataloader = DataLoader(
+                train_dataset,
+                batch_sampler=train_batch_sampler,
+                collate_fn=train_dataset.collate,
+                num_workers=self.args.dataloader_num_workers,
+            )
+        else:
+            train_sampler = RandomSampler(train_dataset)
+
+            train_dataloader = DataLoader(
+                train_dataset,
+                sampler=train_sampler,
+                batch_size=self.args.train_batch_size,
+                collate_fn=getattr(train_dataset, "collate", None),
+                num_workers=self.args.dataloader_num_workers,
+            )
 
         os.makedirs(output_dir, exist_ok=True)
 
@@ -315,7 +396,7 @@ class ClassificationModel():
 
         if verbose:
             logger.info(" Training of {} model complete. Saved to {}.".format(self.args.model_type, output_dir))
-        self.model.to('cpu')
+        self._release_model_from_device()
 
     def train(
             self,
@@ -780,13 +861,12 @@ class ClassificationModel():
                 )
         os.makedirs(eval_output_dir, exist_ok=True)
 
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        eval_dataloader = self._get_eval_dataloader(eval_dataset)
 
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
+        output_arrays = self._get_output_arrays(len(eval_dataset), "eval")
+        offset = 0
         model.eval()
 
         for batch in tqdm(eval_dataloader, disable=args.silent or silent, desc="Running Evaluation"):
@@ -804,13 +884,13 @@ class ClassificationModel():
 
             nb_eval_steps += 1
 
-            if preds is None:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = inputs["labels"].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+            rows = slice(offset, offset + len(logits))
+            offset += len(logits)
+            output_arrays.write("preds", rows, logits.detach().cpu().numpy())
+            output_arrays.write("out_label_ids", rows, inputs["labels"].detach().cpu().numpy())
 
+        preds = output_arrays.get("preds")
+        out_label_ids = output_arrays.get("out_label_ids")
         eval_loss = eval_loss / nb_eval_steps
 
         if args.sliding_window:
@@ -878,14 +958,16 @@ class ClassificationModel():
             self, examples, evaluate=False, no_cache=False, multi_label=False, verbose=True, silent=False
     ):
         """
-        Converts a list of InputExample objects to a TensorDataset containing InputFeatures. Caches the InputFeatures.
+        Converts a list of InputExample objects to a FeatureDataset containing InputFeatures. Caches the InputFeatures.
+
+        The cache is split in shards named after a hash of their examples' content, the tokenizer and the
+        conversion settings, so a shard is only converted again when one of these changes. The shards do
+        not depend on the order of the examples, the rows are put back in input order by the dataset.
+        Shards are only deleted by clean_feature_cache().
 
         Utility function for train() and eval() methods. Not intended to be used directly.
         """
 
-        process_count = self.args.process_count
-
-        tokenizer = self.tokenizer
         args = self.args
 
         if not no_cache:
@@ -900,93 +982,164 @@ class ClassificationModel():
             os.makedirs(self.args.cache_dir, exist_ok=True)
 
         mode = "dev" if evaluate else "train"
-        cached_features_file = os.path.join(
-            args.cache_dir,
-            "cached_{}_{}_{}_{}_{}".format(
-                mode, args.model_type, args.max_seq_length, self.num_labels, len(examples),
-            ),
+        use_cache = not no_cache and (
+            not args.reprocess_input_data or (mode == "dev" and args.use_cached_eval_features)
         )
-
-        if os.path.exists(cached_features_file) and (
-                (not args.reprocess_input_data and not no_cache)
-                or (mode == "dev" and args.use_cached_eval_features and not no_cache)
-        ):
-            features = torch.load(cached_features_file)
+        settings_key = self._features_settings_key(mode, output_mode, multi_label)
+
+        # Sliding window features are not one per example, so they are cached in a single shard
+        shards = split_into_shards(examples, None if args.sliding_window else args.cache_shard_size, settings_key)
+
+        shard_features = [None] * len(shards)
+        if use_cache:
+            for i, (key, _) in enumerate(shards):
+                cached_features_dir = os.path.join(args.cache_dir, "cached_features_{}".format(key))
+                if os.path.isdir(cached_features_dir):
+                    try:
+                        shard_features[i] = FeatureArrays.load(cached_features_dir)
+                    except OSError:
+                        # Deleted by clean_feature_cache() in another process, converted again below
+                        continue
+                    # Marks the shard as used for clean_feature_cache()
+                    os.utime(cached_features_dir)
             if verbose:
-                logger.info(f" Features loaded from cache at {cached_features_file}")
-        else:
+                loaded = sum(features is not None for features in shard_features)
+                logger.info(f" Features of {loaded} of {len(shards)} shards loaded from cache at {args.cache_dir}")
+
+        missing = [i for i, features in enumerate(shard_features) if features is None]
+        if missing:
             if verbose:
-                logger.info(" Converting to features started. Cache is not used.")
+                logger.info(" Converting to features started.")
                 if args.sliding_window:
                     logger.info(" Sliding window enabled")
 
-            # If labels_map is defined, then labels need to be replaced with ints
-            # if self.args.labels_map:
-            #     for example in examples:
-            #         if multi_label:
-            #             example.label = [self.args.labels_map[label] for label in example.label]
-            #         else:
-            #             example.label = self.args.labels_map[example.label]
-
-            features = convert_examples_to_features(
-                examples,
-                args.max_seq_length,
-                tokenizer,
-                output_mode,
-                # XLNet has a CLS token at the end
-                cls_token_at_end=bool(args.model_type in ["xlnet"]),
-                cls_token=tokenizer.cls_token,
-                cls_token_segment_id=2 if args.model_type in ["xlnet"] else 0,
-                sep_token=tokenizer.sep_token,
-                # RoBERTa uses an extra separator b/w pairs of sentences,
-                # cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
-                sep_token_extra=bool(args.model_type in ["roberta", "camembert", "xlmroberta", "longformer"]),
-                # PAD on the left for XLNet
-                pad_on_left=bool(args.model_type in ["xlnet"]),
-                pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-                pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
-                process_count=process_count,
-                multi_label=multi_label,
-                silent=args.silent or silent,
-                use_multiprocessing=args.use_multiprocessing,
-                sliding_window=args.sliding_window,
-                flatten=not evaluate,
-                stride=args.stride,
-                add_prefix_space=bool(args.model_type in ["roberta", "camembert", "xlmroberta", "longformer"]),
-                # avoid padding in case of single example/online inferencing to decrease execution time
-                pad_to_max_length=bool(len(examples) > 1),
-                args=args,
-            )
+            missing_examples = [examples[j] for i in missing for j in shards[i][1]]
+            features = self._convert_examples(missing_examples, output_mode, multi_label, evaluate, silent)
             if verbose and args.sliding_window:
                 logger.info(f" {len(features)} features created from {len(examples)} samples.")
 
-            if not no_cache:
-                torch.save(features, cached_features_file)
-
-        if args.sliding_window and evaluate:
-            features = [
-                [feature_set] if not isinstance(feature_set, list) else feature_set for feature_set in features
-            ]
-            window_counts = [len(sample) for sample in features]
-            features = [feature for feature_set in features for feature in feature_set]
+            if len(missing) == 1:
+                shard_features[missing[0]] = features
+            else:
+                offset = 0
+                for i in missing:
+                    size = len(shards[i][1])
+                    shard_features[i] = features.select(slice(offset, offset + size))
+                    offset += size
 
-        all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
+            if not no_cache:
+                for i in missing:
+                    shard_features[i].save(os.path.join(args.cache_dir, "cached_features_{}".format(shards[i][0])))
 
-        if output_mode == "classification":
-            all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
-            all_feature = torch.tensor([f.feature_id for f in features], dtype=torch.float)
-        elif output_mode == "regression":
-            all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.float)
+        if not shard_features:
+            shard_features = [self._convert_examples(examples, output_mode, multi_label, evaluate, silent)]
+            index = None
+        else:
+            # Row p of the shards is example positions[p], so example i is row index[i]
+            positions = np.concatenate([indexes for _, indexes in shards])
+            index = np.empty_like(positions)
+            index[positions] = np.arange(len(positions))
+            if np.array_equal(positions, np.arange(len(positions))):
+                index = None
 
-        dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_feature)
+        dataset = self._get_feature_dataset(shard_features, index)
 
         if args.sliding_window and evaluate:
-            return dataset, window_counts
+            return dataset, shard_features[0].window_counts.tolist()
         else:
             return dataset
 
+    def _convert_examples(self, examples, output_mode, multi_label, evaluate, silent):
+        tokenizer = self.tokenizer
+        args = self.args
+        # PAD on the left for XLNet
+        pad_on_left = bool(args.model_type in ["xlnet"])
+        pad_token = tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0]
+        pad_token_segment_id = 4 if args.model_type in ["xlnet"] else 0
+
+        # If labels_map is defined, then labels need to be replaced with ints
+        # if self.args.labels_map:
+        #     for example in examples:
+        #         if multi_label:
+        #             example.label = [self.args.labels_map[label] for label in example.label]
+        #         else:
+        #             example.label = self.args.labels_map[example.label]
+
+        features = convert_examples_to_features(
+            examples,
+            args.max_seq_length,
+            tokenizer,
+            output_mode,
+            # XLNet has a CLS token at the end
+            cls_token_at_end=bool(args.model_type in ["xlnet"]),
+            cls_token=tokenizer.cls_token,
+            cls_token_segment_id=2 if args.model_type in ["xlnet"] else 0,
+            sep_token=tokenizer.sep_token,
+            # RoBERTa uses an extra separator b/w pairs of sentences,
+            # cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
+            sep_token_extra=bool(args.model_type in ["roberta", "camembert", "xlmroberta", "longformer"]),
+            pad_on_left=pad_on_left,
+            pad_token=pad_token,
+            pad_token_segment_id=pad_token_segment_id,
+            process_count=args.process_count,
+            multi_label=multi_label,
+            silent=args.silent or silent,
+            use_multiprocessing=args.use_multiprocessing,
+            sliding_window=args.sliding_window,
+            flatten=not evaluate,
+            stride=args.stride,
+            add_prefix_space=bool(args.model_type in ["roberta", "camembert", "xlmroberta", "longformer"]),
+            # Batches are padded by the collate function of the dataset
+            pad_to_max_length=False,
+            deduplicate_text_b=args.deduplicate_text_b,
+            use_fast_tokenizer=args.use_fast_tokenizer,
+            fast_tokenizer_batch_size=args.fast_tokenizer_batch_size,
+            budgeted_tokenization=args.budgeted_tokenization,
+            return_arrays=True,
+            pool=self._get_conversion_pool() if self._uses_conversion_pool() else None,
+            args=args,
+        )
+
+        if args.sliding_window:
+            window_counts = None
+            if evaluate:
+                features = [
+                    [feature_set] if not isinstance(feature_set, list) else feature_set for feature_set in features
+                ]
+                window_counts = np.array([len(sample) for sample in features], dtype=np.int32)
+                features = [feature for feature_set in features for feature in feature_set]
+            features = FeatureArrays.from_features(
+                features,
+                len(features),
+                args.max_seq_length,
+                pad_token=pad_token,
+                pad_token_segment_id=pad_token_segment_id,
+                pad_on_left=pad_on_left,
+                regression=output_mode == "regression",
+            )
+            features.window_counts = window_counts
+
+        return features
+
+    def _features_settings_key(self, mode, output_mode, multi_label):
+        """Everything besides the examples that the converted features depend on."""
+        args = self.args
+        fast_conversion = args.use_fast_tokenizer and supports_fast_conversion(self.tokenizer, args.max_seq_length)
+        settings = [
+            # Layout of the cached arrays
+            FeatureArrays.array_names,
+            self._tokenizer_fingerprint,
+            args.model_type,
+            args.max_seq_length,
+            output_mode,
+            multi_label,
+            fast_conversion,
+        ]
+        if args.sliding_window:
+            # The windows are flattened when training
+            settings += [mode, args.stride]
+        return repr(settings)
+
     def compute_metrics(self, preds, labels, eval_examples=None, multi_label=False, **kwargs):
         """
         Computes the evaluation metrics for the model predictions.
@@ -1045,28 +1198,13 @@ class ClassificationModel():
             model_outputs: A python list of the raw model outputs for each text.
         """
 
-        model = self.model
         args = self.args
 
-        self._move_model_to_device()
-        dummy_label = 0 if not self.args.labels_map else next(iter(self.args.labels_map.keys()))
+        # The ONNX Runtime backend does not use the PyTorch model
+        if not args.onnx_model_path:
+            self._move_model_to_device()
 
-        if multi_label:
-            if isinstance(to_predict[0], list):
-                eval_examples = [
-                    InputExample(i, text[0], text[1], [dummy_label for i in range(self.num_labels)])
-                    for i, text in enumerate(to_predict)
-                ]
-            else:
-                eval_examples = [
-                    InputExample(i, text, None, [dummy_label for i in range(self.num_labels)])
-                    for i, text in enumerate(to_predict)
-                ]
-        else:
-            if len(to_predict[0]) > 2:
-                eval_examples = [InputExample(i, text[0], text[1], 0, text[2]) for i, text in enumerate(to_predict)]
-            else:
-                eval_examples = [InputExample(i, text[0], None, 0, text[1]) for i, text in enumerate(to_predict)]
+        eval_examples = self._get_predict_examples(to_predict, multi_label)
         if args.sliding_window:
             eval_dataset, window_counts = self.load_and_cache_examples(eval_examples, evaluate=True, no_cache=True)
         else:
@@ -1074,81 +1212,12 @@ class ClassificationModel():
                 eval_examples, evaluate=True, multi_label=multi_label, no_cache=True
             )
 
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
-
-        eval_loss = 0.0
-        nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
-
+        output_arrays = self._get_output_arrays(len(eval_dataset), "predict")
+        self._predict_dataset(eval_dataset, output_arrays, multi_label=multi_label)
+        preds = output_arrays.get("preds")
         if self.config.output_hidden_states:
-            for batch in tqdm(eval_dataloader, disable=args.silent, desc="Running Prediction"):
-                model.eval()
-                # batch = tuple(t.to(device) for t in batch)
-
-                with torch.no_grad():
-                    inputs = self._get_inputs_dict(batch)
-                    outputs = model(**inputs)
-                    tmp_eval_loss, logits = outputs[:2]
-                    embedding_outputs, layer_hidden_states = outputs[2][0], outputs[2][1:]
-
-                    if multi_label:
-                        logits = logits.sigmoid()
-
-                    eval_loss += tmp_eval_loss.mean().item()
-
-                nb_eval_steps += 1
-
-                if preds is None:
-                    preds = logits.detach().cpu().numpy()
-                    out_label_ids = inputs["labels"].detach().cpu().numpy()
-                    all_layer_hidden_states = np.array([state.detach().cpu().numpy() for state in layer_hidden_states])
-                    all_embedding_outputs = embedding_outputs.detach().cpu().numpy()
-                else:
-                    preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                    out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
-                    all_layer_hidden_states = np.append(
-                        all_layer_hidden_states,
-                        np.array([state.detach().cpu().numpy() for state in layer_hidden_states]),
-                        axis=1,
-                    )
-                    all_embedding_outputs = np.append(
-                        all_embedding_outputs, embedding_outputs.detach().cpu().numpy(), axis=0
-                    )
-        else:
-            for batch in tqdm(eval_dataloader, disable=args.silent):
-                model.eval()
-                # batch = tuple(t.to(device) for t in batch)
-
-                with torch.no_grad():
-                    inputs = self._get_inputs_dict(batch)
-                    outputs = model(**inputs)
-                    tmp_eval_loss, logits = outputs[:2]
-
-                    if multi_label:
-                        logits = logits.sigmoid()
-
-                    eval_loss += tmp_eval_loss.mean().item()
-
-                nb_eval_steps += 1
-
-                if preds is None:
-                    #logits = torch.sigmoid(logits)
-                    preds = logits.detach().cpu().numpy()
-                    out_label_ids = inputs["labels"].detach().cpu().numpy()
-                else:
-                    #logits = torch.sigmoid(logits)
-                    preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                    out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
-
-        del inputs['input_ids']
-        del inputs['attention_mask']
-        del inputs['labels']
-        del inputs['externalFeatures']
-
-
-        eval_loss = eval_loss / nb_eval_steps
+            all_layer_hidden_states = output_arrays.get("all_layer_hidden_states")
+            all_embedding_outputs = output_arrays.get("all_embedding_outputs")
 
         if args.sliding_window:
             count = 0
@@ -1190,32 +1259,374 @@ class ClassificationModel():
         # if self.args.labels_map and not self.args.regression:
         #     inverse_labels_map = {value: key for key, value in self.args.labels_map.items()}
         #     preds = [inverse_labels_map[pred] for pred in preds]
-        self.model.to('cpu')
+        self._release_model_from_device()
         if self.config.output_hidden_states:
             return preds, model_outputs, all_embedding_outputs, all_layer_hidden_states
         else:
             return preds, model_outputs
 
+    def examples_to_features(self, to_predict, multi_label=False):
+        """
+        Converts a list of text to predict, as given to predict(), to FeatureArrays for predict_features().
+        Not supported with a sliding window.
+        """
+        if not multi_label and self.args.regression:
+            output_mode = "regression"
+        else:
+            output_mode = "classification"
+        examples = self._get_predict_examples(to_predict, multi_label)
+        return self._convert_examples(examples, output_mode, multi_label, evaluate=True, silent=True)
+
+    def predict_features(self, features, multi_label=False, silent=False):
+        """
+        Performs predictions on already converted features.
+
+        Args:
+            features: FeatureArrays (e.g. from examples_to_features()) or FeatureDataset to predict.
+            silent: If silent, tqdm progress bars will be hidden.
+
+        Returns:
+            model_outputs: A numpy array with the raw model outputs for each row of features.
+        """
+        if not self.args.onnx_model_path:
+            self._move_model_to_device()
+        dataset = features if isinstance(features, FeatureDataset) else self._get_feature_dataset([features])
+        output_arrays = OutputArrays(len(dataset))
+        self._predict_dataset(dataset, output_arrays, multi_label=multi_label, silent=silent)
+        self._release_model_from_device()
+        return output_arrays.get("preds")
+
+    def shares_features_with(self, other):
+        """True if the ClassificationModel `other` converts examples to the same features as this model."""
+        return self._features_settings_key("dev", "classification", False) == other._features_settings_key(
+            "dev", "classification", False
+        )
+
+    def _get_predict_examples(self, to_predict, multi_label=False):
+        dummy_label = 0 if not self.args.labels_map else next(iter(self.args.labels_map.keys()))
+
+        if multi_label:
+            if isinstance(to_predict[0], list):
+                return [
+                    InputExample(i, text[0], text[1], [dummy_label for i in range(self.num_labels)])
+                    for i, text in enumerate(to_predict)
+                ]
+            else:
+                return [
+                    InputExample(i, text, None, [dummy_label for i in range(self.num_labels)])
+                    for i, text in enumerate(to_predict)
+                ]
+        else:
+            if len(to_predict[0]) > 2:
+                return [InputExample(i, text[0], text[1], 0, text[2]) for i, text in enumerate(to_predict)]
+            else:
+                return [InputExample(i, text[0], None, 0, text[1]) for i, text in enumerate(to_predict)]
+
+    def _predict_dataset(self, eval_dataset, output_arrays, multi_label=False, silent=False):
+        """Runs the model on `eval_dataset` and writes the logits ("preds") and hidden states into `output_arrays`."""
+        model = self.model
+        args = self.args
+
+        # Batches of examples of similar lengths need less padding, their outputs are written back at their rows
+        order = None
+        if args.sort_by_length and isinstance(eval_dataset, FeatureDataset):
+            order = np.argsort(eval_dataset.lengths, kind="stable")
+        eval_dataloader = self._get_eval_dataloader(eval_dataset, order)
+
+        if args.onnx_model_path:
+            if self.config.output_hidden_states:
+                raise ValueError(
+                    "output_hidden_states is not supported with onnx_model_path, the ONNX graph only returns the logits."
+                )
+            self._predict_dataset_onnx(eval_dataloader, order, output_arrays, multi_label, silent)
+            return
+
+        offset = 0
+        # The logits stay on the device until all the batches are done, so batches run without waiting for copies
+        logits_buffer = None
+        device_order = None if order is None else torch.from_numpy(order).to(self.device)
+        model.eval()
+
+        with self._inference_mode():
+            for batch in tqdm(eval_dataloader, disable=args.silent or silent, desc="Running Prediction"):
+                inputs = self._get_inputs_dict(batch, with_labels=False)
+                outputs = model(**inputs)
+                logits = outputs[0]
+
+                if multi_label:
+                    logits = logits.sigmoid()
+
+                rows = self._batch_rows(offset, len(logits), order)
+                if logits_buffer is None:
+                    logits_buffer = logits.new_empty((len(eval_dataset),) + logits.shape[1:])
+                logits_buffer[self._batch_rows(offset, len(logits), device_order)] = logits
+                offset += len(logits)
+
+                if self.config.output_hidden_states:
+                    embedding_outputs, layer_hidden_states = self._select_hidden_states(outputs[1])
+                    output_arrays.write("all_layer_hidden_states", rows, layer_hidden_states.cpu().numpy(), axis=1)
+                    output_arrays.write("all_embedding_outputs", rows, embedding_outputs.cpu().numpy())
+
+        if logits_buffer is not None:
+            output_arrays.write("preds", slice(None), logits_buffer.cpu().numpy())
+
+    def _predict_dataset_onnx(self, eval_dataloader, order, output_arrays, multi_label=False, silent=False):
+        """Runs the ONNX Runtime session of onnx_model_path on the batches of `eval_dataloader`, see _predict_dataset."""
+        session = self._get_onnx_session()
+        input_names = [graph_input.name for graph_input in session.get_inputs()]
+        offset = 0
+        for batch in tqdm(eval_dataloader, disable=self.args.silent or silent, desc="Running Prediction"):
+            logits = session.run(None, self._get_onnx_inputs(batch, input_names))[0]
+
+            if multi_label:
+                logits = 1 / (1 + np.exp(-logits))
+
+            rows = self._batch_rows(offset, len(logits), order)
+            offset += len(logits)
+            output_arrays.write("preds", rows, logits)
+
+    def onnx_inputs(self, features, input_names=("input_ids", "attention_mask", "externalFeatures")):
+        """
+        Yields the inputs of an ONNX graph exported with export_onnx() for each prediction batch of
+        `features` (e.g. to calibrate the quantization of the graph).
+
+        Args:
+            features: FeatureArrays (e.g. from examples_to_features()) or FeatureDataset.
+            input_names: Names of the inputs of the graph.
+
+        Yields:
+            A dict of numpy arrays for each input name.
+        """
+        dataset = features if isinstance(features, FeatureDataset) else self._get_feature_dataset([features])
+        for batch in self._get_eval_dataloader(dataset):
+            yield self._get_onnx_inputs(batch, input_names)
+
+    def _get_onnx_inputs(self, batch, input_names):
+        inputs = self._get_inputs_dict(batch, with_labels=False)
+        return {name: inputs[name].cpu().numpy() for name in input_names}
+
+    def _get_onnx_session(self):
+        if not onnxruntime_available:
+            raise ImportError("onnx_model_path specified but onnxruntime is not available.")
+        if self._onnx_session is None:
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self._onnx_session = onnxruntime.InferenceSession(
+                self.args.onnx_model_path, options, providers=["CPUExecutionProvider"]
+            )
+        return self._onnx_session
+
+    def use_onnx_model(self, onnx_model_path):
+        """
+        Makes the next predictions run the ONNX graph `onnx_model_path` with ONNX Runtime, or the PyTorch
+        model when `onnx_model_path` is None.
+        """
+        self.args.onnx_model_path = onnx_model_path
+        self._onnx_session = None
+
+    def export_onnx(self, output_path, opset_version=14):
+        """
+        Exports the model to an ONNX graph taking input_ids and attention_mask (and externalFeatures
+        when the classification head uses external features) with dynamic batch and sequence axes, and
+        returning the logits. The graph can then be run with onnx_model_path.
+
+        Args:
+            output_path: Path of the .onnx file to write.
+            opset_version: ONNX opset of the graph.
+        """
+        self.release()
+        model = self.model
+        model.eval()
+        value_head = getattr(self.args, "value_head", 0) or 0
+
+        # Any non padding token works to trace the graph
+        input_ids = torch.full((2, 8), self.tokenizer.cls_token_id, dtype=torch.long)
+        attention_mask = torch.ones_like(input_ids)
+        inputs = (input_ids, attention_mask)
+        input_names = ["input_ids", "attention_mask"]
+        dynamic_axes = {
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "logits": {0: "batch"},
+        }
+        if value_head:
+            inputs += (torch.zeros((2, value_head), dtype=torch.float),)
+            input_names.append("externalFeatures")
+            dynamic_axes["externalFeatures"] = {0: "batch"}
+
+        # Early exit depends on the data, the graph always runs all the layers
+        early_exit_threshold = getattr(model, "early_exit_threshold", None)
+        if early_exit_threshold is not None:
+            model.early_exit_threshold = None
+        try:
+            with torch.no_grad():
+                torch.onnx.export(
+                    OnnxExportModule(model, with_features=bool(value_head)),
+                    inputs,
+                    output_path,
+                    input_names=input_names,
+                    output_names=["logits"],
+                    dynamic_axes=dynamic_axes,
+                    opset_version=opset_version,
+                    do_constant_folding=True,
+                )
+        finally:
+            if early_exit_threshold is not None:
+                model.early_exit_threshold = early_exit_threshold
+
+    def clean_feature_cache(self, max_age_days=30):
+        """
+        Deletes the shards of the feature cache in cache_dir that were neither written nor loaded in the
+        last `max_age_days` days, whichever data set or model they were converted for.
+
+        Returns:
+            The number of deleted shards.
+        """
+        return clean_feature_cache(self.args.cache_dir, max_age_days)
+
+    def close_conversion_pool(self):
+        """Stops the worker processes used to convert examples to features."""
+        if self._conversion_pool is not None:
+            self._conversion_pool.close()
+            self._conversion_pool.join()
+            self._conversion_pool = None
+
+    def _uses_conversion_pool(self):
+        fast_conversion = self.args.use_fast_tokenizer and supports_fast_conversion(
+            self.tokenizer, self.args.max_seq_length
+        )
+        return self.args.use_multiprocessing and not self.args.sliding_window and not fast_conversion
+
+    def _get_conversion_pool(self):
+        # Started on first use and kept for the next train_model/eval_model/predict calls
+        if self._conversion_pool is None:
+            self._conversion_pool = create_conversion_pool(self.tokenizer, self.args.process_count)
+        return self._conversion_pool
+
     def _threshold(self, x, threshold):
         if x >= threshold:
             return 1
         return 0
 
+    def release(self):
+        """
+        Moves the model back to the CPU and frees the cached GPU memory. Needed to free the device when
+        keep_model_on_device is set, since the model then stays on it between calls.
+        """
+        self.model.to("cpu")
+        self._model_on_device = False
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.empty_cache()
+
     def _move_model_to_device(self):
-        self.model.to(self.device)
+        if not self._model_on_device:
+            self.model.to(self.device)
+            self._model_on_device = True
+
+    def _release_model_from_device(self):
+        if not self.args.keep_model_on_device:
+            self.release()
+
+    def _get_eval_dataloader(self, eval_dataset, order=None):
+        """
+        DataLoader going through `eval_dataset` in order, or in the order `order`, in batches of
+        eval_batch_size examples or, with max_tokens_per_batch, of up to max_tokens_per_batch padded tokens.
+        """
+        args = self.args
+        # Pinned batches are copied to the GPU without blocking (see _get_inputs_dict)
+        pin_memory = torch.device(self.device).type == "cuda"
+        if not isinstance(eval_dataset, FeatureDataset):
+            return DataLoader(
+                eval_dataset,
+                sampler=SequentialSampler(eval_dataset),
+                batch_size=args.eval_batch_size,
+                pin_memory=pin_memory,
+            )
+
+        collate = eval_dataset.collate
+        if self.config.output_hidden_states and not args.hidden_states_cls_only:
+            # Hidden states of all the batches are concatenated, so they need the same width
+            collate = partial(collate, pad_to_length=args.max_seq_length)
+
+        batch_sampler = OrderedBatchSampler(
+            eval_dataset.lengths, args.eval_batch_size, max_tokens=args.max_tokens_per_batch, order=order
+        )
+        return DataLoader(eval_dataset, batch_sampler=batch_sampler, collate_fn=collate, pin_memory=pin_memory)
+
+    def _get_feature_dataset(self, features, index=None):
+        return FeatureDataset(
+            features, pad_to_length=None if self.args.dynamic_padding else self.args.max_seq_length, index=index
+        )
 
-    def _get_inputs_dict(self, batch):
+    def _get_output_arrays(self, num_rows, name):
+        """
+        OutputArrays for `num_rows` rows, memory-mapped from outputs_dir/`name` when outputs_dir is set.
+        The files are overwritten by the next call using the same `name`.
+        """
+        directory = os.path.join(self.args.outputs_dir, name) if self.args.outputs_dir else None
+        return OutputArrays(num_rows, directory)
+
+    @staticmethod
+    def _batch_rows(offset, batch_size, order=None):
+        """
+        Rows of the outputs of the batch starting at `offset` of a DataLoader going in the order `order`
+        (a numpy array, or a tensor to index tensors on its device).
+        """
+        if order is None:
+            return slice(offset, offset + batch_size)
+        return order[offset: offset + batch_size]
+
+    def _select_hidden_states(self, hidden_states):
+        """
+        Splits the hidden states returned by the model in the embedding outputs and the stacked layer
+        outputs, keeping the layers in hidden_states_layers (all by default) and, with
+        hidden_states_cls_only, only the vectors of the [CLS] token.
+        """
+        embedding_outputs, layer_hidden_states = hidden_states[0], hidden_states[1:]
+        if self.args.hidden_states_layers is not None:
+            layer_hidden_states = [layer_hidden_states[layer] for layer in self.args.hidden_states_layers]
+        if self.args.hidden_states_cls_only:
+            # XLNet has a CLS token at the end
+            cls_index = -1 if self.args.model_type in ["xlnet"] else 0
+            embedding_outputs = embedding_outputs[:, cls_index]
+            layer_hidden_states = [state[:, cls_index] for state in layer_hidden_states]
+        return embedding_outputs.detach(), torch.stack(layer_hidden_states).detach()
+
+    @staticmethod
+    def _inference_mode():
+        # torch.inference_mode also skips the version counter and view tracking of no_grad (torch >= 1.9)
+        if hasattr(torch, "inference_mode"):
+            return torch.inference_mode()
+        return torch.no_grad()
+
+    def _get_inputs_dict(self, batch, with_labels=True):
+        """Model inputs of a batch. Without `with_labels` the model gets no labels and computes no loss."""
         if isinstance(batch[0], dict):
-            inputs = {key: value.squeeze().to(self.device) for key, value in batch[0].items()}
-            inputs["labels"] = batch[1].to(self.device)
+            inputs = {key: value.squeeze().to(self.device, non_blocking=True) for key, value in batch[0].items()}
+            if with_labels:
+                inputs["labels"] = batch[1].to(self.device, non_blocking=True)
         else:
-            batch = tuple(t.to(self.device) for t in batch)
+            batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+            input_ids, lengths, segment_ids, label_ids, feature_ids = batch
 
-            inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3], "externalFeatures": batch[4]}
+            # The attention mask covers the first (last for left padding) `lengths` tokens of each row
+            positions = torch.arange(input_ids.size(1), device=input_ids.device)
+            if self.args.model_type in ["xlnet"]:
+                attention_mask = positions.unsqueeze(0) >= (input_ids.size(1) - lengths.long()).unsqueeze(1)
+            else:
+                attention_mask = positions.unsqueeze(0) < lengths.long().unsqueeze(1)
+
+            inputs = {
+                "input_ids": input_ids.long(),
+                "attention_mask": attention_mask.long(),
+                "externalFeatures": feature_ids,
+            }
+            if with_labels:
+                inputs["labels"] = label_ids if self.args.regression else label_ids.long()
 
             # XLM, DistilBERT and RoBERTa don't use segment_ids
             if self.args.model_type != "distilbert":
-                inputs["token_type_ids"] = batch[2] if self.args.model_type in ["bert", "xlnet", "albert"] else None
+                inputs["token_type_ids"] = segment_ids.long() if self.args.model_type in ["bert", "xlnet", "albert"] else None
 
         return inputs
 
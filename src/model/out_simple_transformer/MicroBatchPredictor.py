@@ -0,0 +1,135 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Put in the queue by close() to stop the worker thread
+_STOP = object()
+
+
+class MicroBatchPredictor():
+    """
+    Long-lived predictor on top of a loaded ClassificationModel for online requests.
+
+    Requests submitted from any thread are queued and a single worker thread groups them in
+    micro-batches: a batch starts with the first waiting request and takes the requests arriving
+    within `max_wait` seconds, up to `max_batch_size` of them. Each batch is converted and run with
+    ClassificationModel.examples_to_features() and predict_features(), and every request gets a
+    Future with its row of raw model outputs.
+
+    The model is kept on its device while the predictor runs (see keep_model_on_device).
+
+    Example:
+        with MicroBatchPredictor(model, max_batch_size=16, max_wait=0.005) as predictor:
+            future = predictor.submit(headline, body, features)
+            label = future.result().argmax()
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait=0.01, multi_label=False):
+        if model.args.sliding_window:
+            raise ValueError("MicroBatchPredictor does not support sliding_window")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.multi_label = multi_label
+
+        self._keep_model_on_device = model.args.keep_model_on_device
+        model.args.keep_model_on_device = True
+
+        self._requests = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="MicroBatchPredictor", daemon=True)
+        self._worker.start()
+
+    def submit(self, text_a, text_b=None, features=None):
+        """
+        Queues a request and returns a Future for its raw model outputs (a numpy array).
+
+        Args:
+            text_a: Text of the example (the headline for FNC).
+            text_b: Second text of the pair (the body for FNC), if the model takes pairs.
+            features: External features of the example, if the model takes them.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("MicroBatchPredictor is closed")
+            self._requests.put(((text_a, text_b, features), future))
+        return future
+
+    def predict(self, text_a, text_b=None, features=None, timeout=None):
+        """Submits a request and waits for its raw model outputs."""
+        return self.submit(text_a, text_b, features).result(timeout)
+
+    def close(self):
+        """Runs the requests already queued, stops the worker thread and releases the model's device."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._requests.put(_STOP)
+        self._worker.join()
+        self.model.args.keep_model_on_device = self._keep_model_on_device
+        if not self._keep_model_on_device:
+            self.model.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            request = self._requests.get()
+            if request is _STOP:
+                break
+
+            batch = [request]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is _STOP:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            self._predict_batch(batch)
+
+    def _predict_batch(self, batch):
+        batch = [(example, future) for example, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        # Same layouts as ClassificationModel.predict() inputs
+        pairs = any(text_b is not None for (_, text_b, _), _ in batch)
+        if self.multi_label:
+            to_predict = [[text_a, text_b] if pairs else text_a for (text_a, text_b, _), _ in batch]
+        elif pairs:
+            to_predict = [[text_a, text_b, features] for (text_a, text_b, features), _ in batch]
+        else:
+            to_predict = [[text_a, features] for (text_a, _, features), _ in batch]
+
+        try:
+            features = self.model.examples_to_features(to_predict, multi_label=self.multi_label)
+            model_outputs = self.model.predict_features(features, multi_label=self.multi_label, silent=True)
+        except Exception as e:
+            logger.exception("Prediction of a micro-batch of %d requests failed", len(batch))
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), outputs in zip(batch, model_outputs):
+            future.set_result(outputs)
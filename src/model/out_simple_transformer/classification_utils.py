@@ -1,3 +1,12 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import partial
 from io import open
 from multiprocessing import Pool, cpu_count
 
@@ -15,15 +24,47 @@ from sklearn.metrics import f1_score, matthews_corrcoef
 from tqdm.auto import tqdm
 import linecache
 
+import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+
+# Start of a whitespace run, where a text can be cut without changing the tokens before it
+_WORD_END = re.compile(r"(?<=\S)\s")
+
+# Tokenizer of a conversion pool worker, set once by init_conversion_worker
+_worker_tokenizer = None
+
+
+def init_conversion_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def create_conversion_pool(tokenizer, process_count):
+    """
+    Creates a process pool for the feature conversion. The tokenizer is sent to each worker once, when it
+    starts, so the tasks only carry the examples. The pool can be reused for any number of conversions
+    with the same tokenizer.
+    """
+    return Pool(process_count, initializer=init_conversion_worker, initargs=(tokenizer,))
+
+
+@contextmanager
+def _conversion_pool(pool, tokenizer, process_count):
+    if pool is not None:
+        yield pool
+    else:
+        with create_conversion_pool(tokenizer, process_count) as p:
+            yield p
 
 
 class InputExample(object):
     """A single training/test example for simple sequence classification."""
 
-    def __init__(self, guid, text_a, text_b=None, label=None, features=None, x0=None, y0=None, x1=None, y1=None):
+    __slots__ = ("guid", "text_a", "text_b", "label", "features")
+
+    def __init__(self, guid, text_a, text_b=None, label=None, features=None):
         """
         Constructs a InputExample.
 
@@ -35,6 +76,7 @@ class InputExample(object):
             Only must be specified for sequence pair tasks.
             label: (Optional) string. The label of the example. This should be
             specified for train and dev examples, but not for test examples.
+            features: (Optional) The external features of the example.
         """
 
         self.guid = guid
@@ -42,23 +84,413 @@ class InputExample(object):
         self.text_b = text_b
         self.label = label
         self.features = features
-        if x0 is None:
-            self.bboxes = None
-        else:
-            self.bboxes = [[a, b, c, d] for a, b, c, d in zip(x0, y0, x1, y1)]
 
 
 class InputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask, segment_ids, label_id, feature_id, bboxes=None):
+    __slots__ = ("input_ids", "input_mask", "segment_ids", "label_id", "feature_id")
+
+    def __init__(self, input_ids, input_mask, segment_ids, label_id, feature_id=None):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
         self.label_id = label_id
         self.feature_id = feature_id
-        if bboxes:
-            self.bboxes = bboxes
+
+
+class FeatureArrays(object):
+    """
+    Features of a dataset in contiguous NumPy arrays.
+
+    The tokens of the rows are stored unpadded one after the other: the tokens of row i are
+    input_ids[offsets[i]:offsets[i + 1]] (int32), with their segment ids in segment_ids (int8).
+    label_ids and feature_ids hold the label and the external features of each row. Rows are only
+    padded when they are batched, with pad_token and pad_token_segment_id (see collate_features).
+    With a sliding window, window_counts holds the number of rows of each example.
+    """
+
+    array_names = ("input_ids", "segment_ids", "offsets", "label_ids", "feature_ids")
+
+    def __init__(
+        self,
+        input_ids,
+        segment_ids,
+        offsets,
+        label_ids,
+        feature_ids,
+        pad_token=0,
+        pad_token_segment_id=0,
+        pad_on_left=False,
+        window_counts=None,
+    ):
+        self.input_ids = input_ids
+        self.segment_ids = segment_ids
+        self.offsets = offsets
+        self.label_ids = label_ids
+        self.feature_ids = feature_ids
+        self.pad_token = pad_token
+        self.pad_token_segment_id = pad_token_segment_id
+        self.pad_on_left = pad_on_left
+        self.window_counts = window_counts
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        """Number of tokens of each row."""
+        return np.diff(self.offsets)
+
+    @classmethod
+    def from_features(
+        cls,
+        features,
+        num_features,
+        max_seq_length,
+        pad_token=0,
+        pad_token_segment_id=0,
+        pad_on_left=False,
+        regression=False,
+    ):
+        """Writes an iterable of `num_features` InputFeatures (padded or not) into the arrays, without their padding."""
+        input_ids = np.empty(num_features * max_seq_length, dtype=np.int32)
+        segment_ids = np.empty(num_features * max_seq_length, dtype=np.int8)
+        offsets = np.zeros(num_features + 1, dtype=np.int64)
+        label_ids = None
+        feature_ids = None
+
+        position = 0
+        for i, feature in enumerate(features):
+            feature_id = feature.feature_id if feature.feature_id is not None else 0
+            if label_ids is None:
+                label_ids = np.zeros(
+                    (num_features,) + np.shape(feature.label_id), dtype=np.float32 if regression else np.int32
+                )
+                feature_ids = np.zeros((num_features,) + np.shape(feature_id), dtype=np.float32)
+            length = sum(feature.input_mask)
+            tokens = slice(len(feature.input_ids) - length, None) if pad_on_left else slice(0, length)
+            input_ids[position : position + length] = feature.input_ids[tokens]
+            segment_ids[position : position + length] = feature.segment_ids[tokens]
+            position += length
+            offsets[i + 1] = position
+            label_ids[i] = feature.label_id
+            feature_ids[i] = feature_id
+
+        if label_ids is None:
+            label_ids = np.zeros(0, dtype=np.float32 if regression else np.int32)
+            feature_ids = np.zeros(0, dtype=np.float32)
+
+        return cls(
+            input_ids[:position].copy(),
+            segment_ids[:position].copy(),
+            offsets,
+            label_ids,
+            feature_ids,
+            pad_token=pad_token,
+            pad_token_segment_id=pad_token_segment_id,
+            pad_on_left=pad_on_left,
+        )
+
+    def select(self, index):
+        """FeatureArrays with the rows given by `index` (a slice gives views, an index array copies)."""
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                index = np.arange(start, stop, step)
+        if isinstance(index, slice):
+            stop = max(start, stop)
+            first, last = self.offsets[start], self.offsets[stop]
+            input_ids = self.input_ids[first:last]
+            segment_ids = self.segment_ids[first:last]
+            offsets = self.offsets[start : stop + 1] - first
+        else:
+            index = np.asarray(index, dtype=np.int64)
+            starts, ends = self.offsets[index], self.offsets[index + 1]
+            tokens = np.concatenate([np.arange(first, last) for first, last in zip(starts, ends)] or [[]])
+            tokens = tokens.astype(np.int64)
+            input_ids = self.input_ids[tokens]
+            segment_ids = self.segment_ids[tokens]
+            offsets = np.concatenate([[0], np.cumsum(ends - starts)]).astype(np.int64)
+        return FeatureArrays(
+            input_ids,
+            segment_ids,
+            offsets,
+            self.label_ids[index],
+            self.feature_ids[index],
+            pad_token=self.pad_token,
+            pad_token_segment_id=self.pad_token_segment_id,
+            pad_on_left=self.pad_on_left,
+        )
+
+    def save(self, directory):
+        """
+        Saves each array as a .npy file in `directory`. The files are written in a temporary directory
+        which then replaces `directory`, so a reader never sees a partially written cache.
+        """
+        parent = os.path.dirname(os.path.abspath(directory))
+        temporary_directory = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+        try:
+            for name in self.array_names:
+                np.save(os.path.join(temporary_directory, name + ".npy"), getattr(self, name))
+            padding = np.array([self.pad_token, self.pad_token_segment_id, self.pad_on_left], dtype=np.int64)
+            np.save(os.path.join(temporary_directory, "padding.npy"), padding)
+            if self.window_counts is not None:
+                np.save(os.path.join(temporary_directory, "window_counts.npy"), np.asarray(self.window_counts))
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            os.replace(temporary_directory, directory)
+        finally:
+            if os.path.isdir(temporary_directory):
+                shutil.rmtree(temporary_directory)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="c"):
+        """
+        Loads FeatureArrays saved with `save`. The arrays are memory-mapped copy-on-write by default, so
+        loading costs no reads and processes loading the same cache share its pages.
+        """
+        arrays = [_load_array(os.path.join(directory, name + ".npy"), mmap_mode) for name in cls.array_names]
+        pad_token, pad_token_segment_id, pad_on_left = np.load(os.path.join(directory, "padding.npy")).tolist()
+        window_counts_file = os.path.join(directory, "window_counts.npy")
+        window_counts = np.load(window_counts_file) if os.path.exists(window_counts_file) else None
+        return cls(
+            *arrays,
+            pad_token=pad_token,
+            pad_token_segment_id=pad_token_segment_id,
+            pad_on_left=bool(pad_on_left),
+            window_counts=window_counts
+        )
+
+    def row(self, index):
+        """(input_ids, segment_ids, label_id, feature_id) of a row, unpadded."""
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.input_ids[start:end], self.segment_ids[start:end], self.label_ids[index], self.feature_ids[index]
+
+
+class FeatureDataset(Dataset):
+    """
+    Dataset over one or more FeatureArrays (e.g. the shards of the feature cache) with unpadded rows.
+    Use `collate` as the collate_fn of its DataLoader to pad each batch to its longest row, or to
+    `pad_to_length` when given.
+
+    Row i of the dataset is row `index[i]` of the shards put one after the other, or row i when no
+    `index` is given.
+    """
+
+    def __init__(self, features, pad_to_length=None, index=None):
+        self.shards = list(features) if isinstance(features, (list, tuple)) else [features]
+        self.boundaries = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.index = None if index is None else np.asarray(index, dtype=np.int64)
+        first = self.shards[0]
+        self.collate = partial(
+            collate_features,
+            pad_token=first.pad_token,
+            pad_token_segment_id=first.pad_token_segment_id,
+            pad_on_left=first.pad_on_left,
+            pad_to_length=pad_to_length,
+        )
+
+    def __len__(self):
+        return int(self.boundaries[-1]) if self.index is None else len(self.index)
+
+    def __getitem__(self, index):
+        if self.index is not None:
+            index = int(self.index[index])
+        shard = int(np.searchsorted(self.boundaries, index, side="right")) - 1
+        return self.shards[shard].row(index - self.boundaries[shard])
+
+    @property
+    def lengths(self):
+        """Number of tokens of each row."""
+        lengths = np.concatenate([shard.lengths for shard in self.shards])
+        return lengths if self.index is None else lengths[self.index]
+
+
+def collate_features(batch, pad_token=0, pad_token_segment_id=0, pad_on_left=False, pad_to_length=None):
+    """
+    Pads a list of FeatureDataset rows to the longest one (or to `pad_to_length`) and returns the
+    batch as tensors (input_ids, lengths, segment_ids, label_ids, feature_ids).
+    """
+    lengths = np.array([len(input_ids) for input_ids, _, _, _ in batch], dtype=np.int64)
+    width = pad_to_length or int(lengths.max())
+    input_ids = np.full((len(batch), width), pad_token, dtype=np.int64)
+    segment_ids = np.full((len(batch), width), pad_token_segment_id, dtype=np.int64)
+    for i, (row_input_ids, row_segment_ids, _, _) in enumerate(batch):
+        tokens = slice(width - lengths[i], None) if pad_on_left else slice(0, lengths[i])
+        input_ids[i, tokens] = row_input_ids
+        segment_ids[i, tokens] = row_segment_ids
+    label_ids = np.stack([label_id for _, _, label_id, _ in batch])
+    feature_ids = np.stack([feature_id for _, _, _, feature_id in batch])
+    return (
+        torch.from_numpy(input_ids),
+        torch.from_numpy(lengths),
+        torch.from_numpy(segment_ids),
+        torch.from_numpy(label_ids),
+        torch.from_numpy(feature_ids),
+    )
+
+
+def split_into_batches(indices, lengths, batch_size=None, max_tokens=None):
+    """
+    Cuts `indices` in consecutive batches of `batch_size` rows or, with `max_tokens`, in batches whose
+    padded size (rows * longest row) stays within `max_tokens`. A row longer than `max_tokens` gets a
+    batch of its own.
+    """
+    if not max_tokens:
+        return [indices[start : start + batch_size] for start in range(0, len(indices), batch_size)]
+
+    batches = []
+    start = 0
+    longest = 0
+    for end, length in enumerate(lengths[indices]):
+        longest = max(longest, int(length))
+        if end > start and (end + 1 - start) * longest > max_tokens:
+            batches.append(indices[start:end])
+            start = end
+            longest = int(length)
+    if start < len(indices):
+        batches.append(indices[start:])
+    return batches
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler putting rows of similar length together so batches need little padding.
+
+    The rows are shuffled and cut into buckets of `batch_size * bucket_size_multiplier` rows, each
+    bucket is sorted by length and cut into batches, and the batches of all the buckets are shuffled,
+    so every epoch still sees different batches in a random order. With `max_tokens` the batches are
+    cut by padded size instead of by `batch_size` (see split_into_batches), so the number of batches
+    changes between epochs; len() gives the one of the next epoch.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        bucket_size_multiplier=100,
+        shuffle=True,
+        drop_last=False,
+        generator=None,
+        max_tokens=None,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * max(bucket_size_multiplier, 1)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.max_tokens = max_tokens
+        self._batches = None
+
+    def _plan_batches(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths), generator=self.generator).numpy()
+        else:
+            order = np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start : start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            for batch in split_into_batches(bucket, self.lengths, self.batch_size, self.max_tokens):
+                if self.max_tokens or len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=self.generator).tolist()]
+        return batches
+
+    def __iter__(self):
+        batches = self._batches if self._batches is not None else self._plan_batches()
+        self._batches = None
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self._plan_batches()
+        return len(self._batches)
+
+
+class OrderedBatchSampler(Sampler):
+    """
+    Batch sampler going through the rows in a fixed order, the input order unless `order` is given,
+    in batches of `batch_size` rows or of up to `max_tokens` padded tokens (see split_into_batches).
+    """
+
+    def __init__(self, lengths, batch_size=None, max_tokens=None, order=None):
+        self.lengths = np.asarray(lengths)
+        order = np.arange(len(self.lengths)) if order is None else np.asarray(order)
+        self.batches = split_into_batches(order, self.lengths, batch_size, max_tokens)
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class OnnxExportModule(nn.Module):
+    """
+    Wraps a sequence classification model for torch.onnx.export: takes the inputs as positional
+    arguments (externalFeatures only when the classification head uses them) and returns the logits.
+    """
+
+    def __init__(self, model, with_features):
+        super().__init__()
+        self.model = model
+        self.with_features = with_features
+
+    def forward(self, input_ids, attention_mask, externalFeatures=None):
+        if not self.with_features:
+            externalFeatures = None
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, externalFeatures=externalFeatures)[0]
+
+
+class OutputArrays(object):
+    """
+    Outputs of evaluate/predict for `num_rows` rows, filled in place batch by batch. Each array is
+    allocated at its first write, once the shape of its rows is known. With `directory` the arrays
+    are .npy files memory-mapped from it, so outputs larger than memory (e.g. hidden states) fit.
+    """
+
+    def __init__(self, num_rows, directory=None):
+        self.num_rows = num_rows
+        self.directory = directory
+        self.arrays = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, name, rows, values, axis=0):
+        """Writes `values` at the rows `rows` (a slice or an index array) along `axis` of the array `name`."""
+        array = self.arrays.get(name)
+        if array is None:
+            shape = list(values.shape)
+            shape[axis] = self.num_rows
+            if self.directory:
+                array = np.lib.format.open_memmap(
+                    os.path.join(self.directory, name + ".npy"), mode="w+", dtype=values.dtype, shape=tuple(shape)
+                )
+            else:
+                array = np.empty(shape, dtype=values.dtype)
+            self.arrays[name] = array
+        index = [slice(None)] * array.ndim
+        index[axis] = rows
+        array[tuple(index)] = values
+
+    def get(self, name):
+        return self.arrays.get(name)
+
+
+def _load_array(file, mmap_mode):
+    # Empty arrays cannot be memory-mapped
+    array = np.load(file, mmap_mode=mmap_mode)
+    if mmap_mode is not None and array.size == 0:
+        return np.array(array)
+    return array
 
 
 def convert_example_to_feature(
@@ -88,44 +520,42 @@ def convert_example_to_feature(
         pad_token,
         add_prefix_space,
         pad_to_max_length,
+        cached_tokens_b,
+        budgeted_tokenization,
     ) = example_row
 
-    bboxes = []
-    if example.bboxes:
-        tokens_a = []
-        for word, bbox in zip(example.text_a.split(), example.bboxes):
-            word_tokens = tokenizer.tokenize(word)
-            tokens_a.extend(word_tokens)
-            bboxes.extend([bbox] * len(word_tokens))
+    if tokenizer is None:
+        tokenizer = _worker_tokenizer
 
-        cls_token_box = [0, 0, 0, 0]
-        sep_token_box = [1000, 1000, 1000, 1000]
-        pad_token_box = [0, 0, 0, 0]
-
-    else:
-        # if add_prefix_space and not example.text_a.startswith(" "):
-        #     tokens_a = tokenizer.tokenize(" " + example.text_a)
-        # else:
-        tokens_a = tokenizer.tokenize(example.text_a)
+    # if add_prefix_space and not example.text_a.startswith(" "):
+    #     tokens_a = tokenizer.tokenize(" " + example.text_a)
+    # else:
+    tokens_a = tokenizer.tokenize(example.text_a)
 
     tokens_b = None
     if example.text_b:
         # if add_prefix_space and not example.text_b.startswith(" "):
         #     tokens_b = tokenizer.tokenize(" " + example.text_b)
         # else:
-        tokens_b = tokenizer.tokenize(example.text_b)
-        # Modifies `tokens_a` and `tokens_b` in place so that the total
-        # length is less than the specified length.
         # Account for [CLS], [SEP], [SEP] with "- 3". " -4" for RoBERTa.
         special_tokens_count = 4 if sep_token_extra else 3
+        if cached_tokens_b is not None:
+            # Copy, the truncation below works in place
+            tokens_b = list(cached_tokens_b)
+        elif budgeted_tokenization:
+            # Tokens of text_b past this budget are always truncated, whatever its length
+            max_length_b = _max_truncated_length_b(len(tokens_a), max_seq_length - special_tokens_count)
+            tokens_b = tokenize_prefix(tokenizer, example.text_b, max_length_b + 1)
+        else:
+            tokens_b = tokenizer.tokenize(example.text_b)
+        # Modifies `tokens_a` and `tokens_b` in place so that the total
+        # length is less than the specified length.
         _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - special_tokens_count)
     else:
         # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
         special_tokens_count = 3 if sep_token_extra else 2
         if len(tokens_a) > max_seq_length - special_tokens_count:
             tokens_a = tokens_a[: (max_seq_length - special_tokens_count)]
-            if example.bboxes:
-                bboxes = bboxes[: (max_seq_length - special_tokens_count)]
 
     # The convention in BERT is:
     # (a) For sequence pairs:
@@ -148,9 +578,6 @@ def convert_example_to_feature(
     tokens = tokens_a + [sep_token]
     segment_ids = [sequence_a_segment_id] * len(tokens)
 
-    if bboxes:
-        bboxes += [sep_token_box]
-
     if tokens_b:
         if sep_token_extra:
             tokens += [sep_token]
@@ -166,8 +593,6 @@ def convert_example_to_feature(
     else:
         tokens = [cls_token] + tokens
         segment_ids = [cls_token_segment_id] + segment_ids
-        if bboxes:
-            bboxes = [cls_token_box] + bboxes
 
     input_ids = tokenizer.convert_tokens_to_ids(tokens)
 
@@ -186,14 +611,10 @@ def convert_example_to_feature(
             input_ids = input_ids + ([pad_token] * padding_length)
             input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
             segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
-            if bboxes:
-                bboxes += [pad_token_box] * padding_length
 
         assert len(input_ids) == max_seq_length
         assert len(input_mask) == max_seq_length
         assert len(segment_ids) == max_seq_length
-        if bboxes:
-            assert len(bboxes) == max_seq_length
     # if output_mode == "classification":
     #     label_id = label_map[example.label]
     # elif output_mode == "regression":
@@ -202,14 +623,9 @@ def convert_example_to_feature(
     #     raise KeyError(output_mode)
 
     # if output_mode == "regression":
-    if bboxes:
-        return InputFeatures(
-            input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_id=example.label, feature_id=example.features, bboxes=bboxes
-        )
-    else:
-        return InputFeatures(
-            input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_id=example.label, feature_id=example.features
-        )
+    return InputFeatures(
+        input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_id=example.label, feature_id=example.features
+    )
 
 
 def convert_examples_to_features(
@@ -237,6 +653,12 @@ def convert_examples_to_features(
     stride=None,
     add_prefix_space=False,
     pad_to_max_length=True,
+    deduplicate_text_b=False,
+    use_fast_tokenizer=False,
+    fast_tokenizer_batch_size=1000,
+    budgeted_tokenization=False,
+    return_arrays=False,
+    pool=None,
     args=None,
 ):
     """ Loads a data file into a list of `InputBatch`s
@@ -244,13 +666,81 @@ def convert_examples_to_features(
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `deduplicate_text_b` tokenizes every distinct text_b once and reuses its tokens for all
+            the examples sharing it (FNC bodies are paired with many headlines)
+        `use_fast_tokenizer` encodes the examples in batches of `fast_tokenizer_batch_size` with a
+            fast (Rust) tokenizer, see convert_examples_to_features_fast. Ignored when the tokenizer
+            is not a fast one or the model layout is not supported there (CLS at end, left padding).
+        `budgeted_tokenization` only tokenizes the beginning of text_b that can survive the pair
+            truncation, instead of tokenizing whole bodies to throw most of their tokens away.
+        `return_arrays` returns a FeatureArrays instead of a list of InputFeatures. The features are
+            then converted unpadded and written straight into its arrays; `pad_to_max_length` is
+            left to the collate function.
+        `pool` is a pool from create_conversion_pool, with the same tokenizer, to use instead of
+            starting a new one.
     """
 
+    if return_arrays and not sliding_window:
+        to_arrays = partial(
+            FeatureArrays.from_features,
+            num_features=len(examples),
+            max_seq_length=max_seq_length,
+            pad_token=pad_token,
+            pad_token_segment_id=pad_token_segment_id,
+            pad_on_left=pad_on_left,
+            regression=output_mode == "regression",
+        )
+        pad_to_max_length = False
+    else:
+        to_arrays = None
+
+    if use_fast_tokenizer and supports_fast_conversion(tokenizer, max_seq_length):
+        if not (sliding_window or cls_token_at_end or pad_on_left):
+            features = iter_features_fast(
+                examples,
+                max_seq_length,
+                tokenizer,
+                pad_token_segment_id=pad_token_segment_id,
+                pad_to_max_length=pad_to_max_length,
+                batch_size=fast_tokenizer_batch_size,
+                silent=silent,
+            )
+            return to_arrays(features) if to_arrays else list(features)
+
+    if deduplicate_text_b and not sliding_window:
+        unique_texts_b = list(dict.fromkeys(example.text_b for example in examples if example.text_b))
+        if budgeted_tokenization:
+            # The budget of text_b is largest when text_a is empty
+            max_tokens = _max_truncated_length_b(0, max_seq_length - (4 if sep_token_extra else 3)) + 1
+        else:
+            max_tokens = None
+        tokens_by_text_b = dict(
+            zip(
+                unique_texts_b,
+                tokenize_texts(
+                    unique_texts_b,
+                    tokenizer,
+                    process_count,
+                    silent=silent,
+                    use_multiprocessing=use_multiprocessing,
+                    max_tokens=max_tokens,
+                    pool=pool,
+                ),
+            )
+        )
+        # Only the short text_a is left to tokenize, it is cheaper to do it here than to
+        # send the body tokens to the workers.
+        use_multiprocessing = False
+    else:
+        tokens_by_text_b = {}
+
+    use_worker_tokenizer = use_multiprocessing and not sliding_window
     examples = [
         (
             example,
             max_seq_length,
-            tokenizer,
+            # The pool workers already have the tokenizer
+            None if use_worker_tokenizer else tokenizer,
             output_mode,
             cls_token_at_end,
             cls_token,
@@ -264,6 +754,8 @@ def convert_examples_to_features(
             pad_token,
             add_prefix_space,
             pad_to_max_length,
+            tokens_by_text_b.get(example.text_b),
+            budgeted_tokenization,
         )
         for example in examples
     ]
@@ -285,14 +777,14 @@ def convert_examples_to_features(
             if flatten:
                 features = [feature for feature_set in features for feature in feature_set]
         else:
-            with Pool(process_count) as p:
-                features = list(
-                    tqdm(
-                        p.imap(convert_example_to_feature, examples, chunksize=chunksize),
-                        total=len(examples),
-                        disable=silent,
-                    )
+            with _conversion_pool(pool, tokenizer, process_count) as p:
+                features = tqdm(
+                    p.imap(convert_example_to_feature, examples, chunksize=chunksize),
+                    total=len(examples),
+                    disable=silent,
                 )
+                # Consumed while the pool is open
+                features = to_arrays(features) if to_arrays else list(features)
     else:
         if sliding_window:
             features = [
@@ -301,11 +793,268 @@ def convert_examples_to_features(
             if flatten:
                 features = [feature for feature_set in features for feature in feature_set]
         else:
-            features = [convert_example_to_feature(example) for example in tqdm(examples, disable=silent)]
+            features = (convert_example_to_feature(example) for example in tqdm(examples, disable=silent))
+            features = to_arrays(features) if to_arrays else list(features)
 
     return features
 
 
+def supports_fast_conversion(tokenizer, max_seq_length):
+    """
+    True if convert_examples_to_features_fast gives the same features as the slow conversion.
+
+    When the tokens left to a pair are odd and text_a is not the longer text, the `longest_first`
+    truncation of tokenizers >= 0.13 gives the extra token to text_b while _truncate_seq_pair gives
+    it to text_a, so the slow conversion is used for those lengths.
+    """
+    if not getattr(tokenizer, "is_fast", False):
+        return False
+    return (max_seq_length - tokenizer.num_special_tokens_to_add(pair=True)) % 2 == 0
+
+
+def convert_examples_to_features_fast(
+    examples,
+    max_seq_length,
+    tokenizer,
+    sequence_a_segment_id=0,
+    sequence_b_segment_id=1,
+    pad_token_segment_id=0,
+    pad_to_max_length=True,
+    batch_size=1000,
+    silent=False,
+):
+    """
+    Converts examples to InputFeatures with a fast tokenizer, encoding `batch_size` examples per call.
+
+    Pairs are truncated with the `longest_first` strategy, which matches _truncate_seq_pair when the
+    tokens left to a pair are even (see supports_fast_conversion), and the special tokens are added by the tokenizer (<s> A </s></s> B </s> for RoBERTa). Segment ids follow
+    convert_example_to_feature: the first sequence and its separator get `sequence_a_segment_id`,
+    the rest `sequence_b_segment_id`.
+    """
+    return list(
+        iter_features_fast(
+            examples,
+            max_seq_length,
+            tokenizer,
+            sequence_a_segment_id=sequence_a_segment_id,
+            sequence_b_segment_id=sequence_b_segment_id,
+            pad_token_segment_id=pad_token_segment_id,
+            pad_to_max_length=pad_to_max_length,
+            batch_size=batch_size,
+            silent=silent,
+        )
+    )
+
+
+def iter_features_fast(
+    examples,
+    max_seq_length,
+    tokenizer,
+    sequence_a_segment_id=0,
+    sequence_b_segment_id=1,
+    pad_token_segment_id=0,
+    pad_to_max_length=True,
+    batch_size=1000,
+    silent=False,
+):
+    """Generator version of convert_examples_to_features_fast, yields the features in order."""
+    padding = "max_length" if pad_to_max_length else False
+
+    for start in tqdm(range(0, len(examples), batch_size), disable=silent):
+        batch = examples[start : start + batch_size]
+        features = [None] * len(batch)
+        # An empty text_b is encoded as a single sequence, as in convert_example_to_feature
+        pairs = [i for i, example in enumerate(batch) if example.text_b]
+        singles = [i for i, example in enumerate(batch) if not example.text_b]
+
+        for indexes, is_pair in ((pairs, True), (singles, False)):
+            if not indexes:
+                continue
+            encoding = tokenizer(
+                [batch[i].text_a for i in indexes],
+                [batch[i].text_b for i in indexes] if is_pair else None,
+                truncation="longest_first",
+                max_length=max_seq_length,
+                padding=padding,
+                return_attention_mask=True,
+                return_token_type_ids=False,
+            )
+            for j, i in enumerate(indexes):
+                input_ids = encoding["input_ids"][j]
+                input_mask = encoding["attention_mask"][j]
+                length = sum(input_mask)
+                if is_pair:
+                    sequence_ids = encoding.sequence_ids(j)
+                    # [CLS] + A + [SEP]
+                    length_a = sequence_ids.count(0) + 2
+                else:
+                    length_a = length
+                segment_ids = (
+                    [sequence_a_segment_id] * length_a
+                    + [sequence_b_segment_id] * (length - length_a)
+                    + [pad_token_segment_id] * (len(input_ids) - length)
+                )
+                example = batch[i]
+                features[i] = InputFeatures(
+                    input_ids=input_ids,
+                    input_mask=input_mask,
+                    segment_ids=segment_ids,
+                    label_id=example.label,
+                    feature_id=example.features,
+                )
+        yield from features
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash identifying what a tokenizer produces: its class, vocabulary, merges and special tokens."""
+    digest = hashlib.sha1(type(tokenizer).__name__.encode("utf-8"))
+    for token, _ in sorted(tokenizer.get_vocab().items(), key=lambda item: item[1]):
+        digest.update(token.encode("utf-8"))
+        digest.update(b"\0")
+    backend_tokenizer = getattr(tokenizer, "backend_tokenizer", None)
+    if backend_tokenizer is not None:
+        # The serialized fast tokenizer holds its model (vocabulary and BPE merges), normalizer, pre-tokenizer
+        # and post-processor. Its truncation and padding are left by the last encode call, not by the files.
+        backend = json.loads(backend_tokenizer.to_str())
+        backend.pop("truncation", None)
+        backend.pop("padding", None)
+        digest.update(json.dumps(backend, sort_keys=True).encode("utf-8"))
+    else:
+        bpe_ranks = getattr(tokenizer, "bpe_ranks", None)
+        if bpe_ranks:
+            for merge, _ in sorted(bpe_ranks.items(), key=lambda item: item[1]):
+                digest.update(" ".join(merge).encode("utf-8"))
+                digest.update(b"\0")
+        sp_model = getattr(tokenizer, "sp_model", None)
+        if sp_model is not None:
+            digest.update(sp_model.serialized_model_proto())
+    digest.update(repr(tokenizer.all_special_tokens).encode("utf-8"))
+    digest.update(repr(tokenizer.init_kwargs.get("do_lower_case")).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def example_digest(example):
+    """Hash of the content of an example (texts, label and external features), not of its guid."""
+    digest = hashlib.sha1(example.text_a.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update((example.text_b or "").encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(repr(example.label).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(np.asarray(example.features if example.features is not None else 0, dtype=np.float32).tobytes())
+    return digest.digest()
+
+
+def split_into_shards(examples, shard_size, settings_key=""):
+    """
+    Splits examples into shards for the feature cache, returning (key, indexes) for each shard, where
+    indexes are the positions in `examples` of the examples of the shard, in the order of the shard.
+
+    The examples are put in the order of their digests, which does not depend on the order of
+    `examples` (e.g. a shuffled training set), and shards end after the examples whose digest is a
+    multiple of `shard_size`. So shards hold `shard_size` examples on average and their boundaries
+    only depend on the examples around them: editing, adding or removing a few examples only changes
+    the keys of the shards holding them. The key of a shard hashes `settings_key` and the digests of
+    its examples. With no `shard_size` all the examples go in a single shard in their input order.
+    """
+    digests = [example_digest(example) for example in examples]
+    if shard_size:
+        order = sorted(range(len(digests)), key=digests.__getitem__)
+    else:
+        order = list(range(len(digests)))
+
+    shards = []
+    start = 0
+    digest = hashlib.sha1(settings_key.encode("utf-8"))
+    for position, i in enumerate(order):
+        digest.update(digests[i])
+        if position == len(order) - 1 or (shard_size and int.from_bytes(digests[i][:8], "big") % shard_size == 0):
+            shards.append((digest.hexdigest(), np.array(order[start : position + 1], dtype=np.int64)))
+            start = position + 1
+            digest = hashlib.sha1(settings_key.encode("utf-8"))
+    return shards
+
+
+def clean_feature_cache(cache_dir, max_age_days, prefix="cached_features_"):
+    """
+    Deletes the shards of the feature cache in `cache_dir` that were neither written nor loaded in
+    the last `max_age_days` days. Returns the number of deleted shards.
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+    oldest = time.time() - max_age_days * 24 * 60 * 60
+    deleted = 0
+    for file_name in os.listdir(cache_dir):
+        shard_dir = os.path.join(cache_dir, file_name)
+        if file_name.startswith(prefix) and os.path.isdir(shard_dir) and os.path.getmtime(shard_dir) < oldest:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+            deleted += 1
+    return deleted
+
+
+def tokenize_texts(
+    texts, tokenizer, process_count, silent=False, use_multiprocessing=True, chunksize=50, max_tokens=None, pool=None
+):
+    """
+    Tokenizes a list of texts, returning the list of tokens of each text in the same order.
+    With `max_tokens` only the first `max_tokens` tokens of each text are computed (see tokenize_prefix).
+    """
+    if use_multiprocessing and len(texts) > chunksize:
+        with _conversion_pool(pool, tokenizer, process_count) as p:
+            return list(
+                tqdm(
+                    p.imap(partial(_tokenize_in_worker, max_tokens=max_tokens), texts, chunksize=chunksize),
+                    total=len(texts),
+                    disable=silent,
+                )
+            )
+    if max_tokens is not None:
+        return [tokenize_prefix(tokenizer, text, max_tokens) for text in tqdm(texts, disable=silent)]
+    return [tokenizer.tokenize(text) for text in tqdm(texts, disable=silent)]
+
+
+def _tokenize_in_worker(text, max_tokens=None):
+    if max_tokens is not None:
+        return tokenize_prefix(_worker_tokenizer, text, max_tokens)
+    return _worker_tokenizer.tokenize(text)
+
+
+def tokenize_prefix(tokenizer, text, max_tokens, chars_per_token=6):
+    """
+    Returns the first `max_tokens` tokens of `text` (or all of them if there are less), tokenizing only
+    a prefix of the text.
+
+    The prefix is cut at the end of a word, where the tokenizers split, so its tokens are the first
+    tokens of the whole text. It starts at `chars_per_token` characters per token and doubles until it
+    gives enough tokens.
+    """
+    end = max_tokens * chars_per_token
+    while end < len(text):
+        match = _WORD_END.search(text, end)
+        if match is None:
+            break
+        tokens = tokenizer.tokenize(text[: match.start()])
+        if len(tokens) >= max_tokens:
+            return tokens[:max_tokens]
+        end = 2 * match.start() + 1
+    return tokenizer.tokenize(text)[:max_tokens]
+
+
+def _max_truncated_length_b(length_a, max_length):
+    """Largest length that _truncate_seq_pair can leave to tokens_b when tokens_a has `length_a` tokens."""
+    return max(max_length - length_a, max_length // 2)
+
+
+def _truncated_pair_lengths(length_a, length_b, max_length):
+    """Lengths of tokens_a and tokens_b after _truncate_seq_pair."""
+    if length_a + length_b <= max_length:
+        return length_a, length_b
+    # The longer sequence is cut down to the shorter one, then both are cut alternately
+    # (tokens_b first on ties), so tokens_b keeps at most _max_truncated_length_b tokens.
+    length_b = min(length_b, _max_truncated_length_b(length_a, max_length))
+    return max_length - length_b, length_b
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
 
@@ -313,15 +1062,11 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     # one token at a time. This makes more sense than truncating an equal percent
     # of tokens from each, since if one sequence is very short then each token
     # that's truncated likely contains more information than a longer sequence.
+    # The final lengths are computed directly and each sequence is sliced once.
 
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
+    length_a, length_b = _truncated_pair_lengths(len(tokens_a), len(tokens_b), max_length)
+    del tokens_a[length_a:]
+    del tokens_b[length_b:]
 
 def convert_example_to_feature_sliding_window(
     example_row,
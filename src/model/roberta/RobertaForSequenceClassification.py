@@ -1,3 +1,5 @@
+import torch
+from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss, BCEWithLogitsLoss
 from model.roberta.RobertaClassificationHead import RobertaClassificationHead
 from transformers.models.bert import BertPreTrainedModel
@@ -27,6 +29,11 @@ class RobertaForSequenceClassification(BertPreTrainedModel):
         **attentions**: (`optional`, returned when ``config.output_attentions=True``)
             list of ``torch.FloatTensor`` (one for each layer) of shape ``(batch_size, num_heads, sequence_length, sequence_length)``:
             Attentions weights after the attention softmax, used to compute the weighted average in the self-attention heads.
+    Early exit:
+        With ``config.early_exit_layers`` (e.g. ``[6, 12, 18]``), a classification head is attached after each of
+        these encoder layers and trained alongside the final one (their losses are added to the loss).
+        With ``config.early_exit_threshold`` set, inference without labels stops for each example at the first
+        of these layers whose softmax confidence reaches the threshold, and returns the logits of that head.
     Examples::
         tokenizer = RobertaTokenizer.from_pretrained('roberta-base')
         model = RobertaForSequenceClassification.from_pretrained('roberta-base')
@@ -47,6 +54,12 @@ class RobertaForSequenceClassification(BertPreTrainedModel):
         self.classifier = RobertaClassificationHead(config, value_head)
         self.weight = weight
 
+        self.early_exit_layers = list(getattr(config, "early_exit_layers", None) or [])
+        self.early_exit_threshold = getattr(config, "early_exit_threshold", None)
+        self.exit_classifiers = nn.ModuleList(
+            [RobertaClassificationHead(config, value_head) for _ in self.early_exit_layers]
+        )
+
 
     def forward(
         self,
@@ -59,24 +72,99 @@ class RobertaForSequenceClassification(BertPreTrainedModel):
         labels=None,
         externalFeatures=None,
     ):
+        use_early_exit = (
+            self.early_exit_layers
+            and self.early_exit_threshold is not None
+            and labels is None
+            and not self.training
+            and not self.config.output_hidden_states
+            and not self.config.output_attentions
+        )
+        if use_early_exit:
+            return (self._forward_early_exit(input_ids, attention_mask, token_type_ids, externalFeatures),)
+
+        # The exit heads only add to the loss, they are not run without labels
+        train_exits = bool(self.early_exit_layers) and labels is not None
         outputs = self.roberta(
             input_ids,
             attention_mask=attention_mask,
             token_type_ids=token_type_ids,
             position_ids=position_ids,
             head_mask=head_mask,
+            output_hidden_states=bool(self.config.output_hidden_states or train_exits),
+            return_dict=True,
         )
-        sequence_output = outputs[0]
+        sequence_output = outputs.last_hidden_state
         logits = self.classifier(sequence_output, externalFeatures=externalFeatures)
 
-        outputs = (logits,) + outputs[2:]
+        extra_outputs = ()
+        if self.config.output_hidden_states:
+            extra_outputs += (outputs.hidden_states,)
+        if self.config.output_attentions:
+            extra_outputs += (outputs.attentions,)
+
+        hidden_states = outputs.hidden_states
+        outputs = (logits,) + extra_outputs
         if labels is not None:
-            if self.num_labels == 1:
-                loss_fct = BCEWithLogitsLoss()
-                loss = loss_fct(logits.view(-1), labels.view(-1))
-            else:
-                loss_fct = CrossEntropyLoss(weight=self.weight)
-                loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+            loss = self._loss(logits, labels)
+            for layer, classifier in zip(self.early_exit_layers, self.exit_classifiers):
+                layer_logits = classifier(hidden_states[layer], externalFeatures=externalFeatures)
+                loss = loss + self._loss(layer_logits, labels)
             outputs = (loss,) + outputs
 
         return outputs  # (loss), logits, (hidden_states), (attentions)
+
+    def _loss(self, logits, labels):
+        if self.num_labels == 1:
+            loss_fct = BCEWithLogitsLoss()
+            return loss_fct(logits.view(-1), labels.view(-1))
+        loss_fct = CrossEntropyLoss(weight=self.weight)
+        return loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+
+    def _confidence(self, logits):
+        if self.num_labels == 1:
+            probabilities = torch.sigmoid(logits.view(-1))
+            return torch.max(probabilities, 1 - probabilities)
+        return logits.softmax(dim=-1).max(dim=-1).values
+
+    def _forward_early_exit(self, input_ids, attention_mask, token_type_ids, externalFeatures):
+        """
+        Runs the encoder layer by layer and, after each exit layer, takes out of the batch the examples whose
+        exit head is confident enough, so the next layers only run on the remaining ones.
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        hidden_states = self.roberta.embeddings(input_ids=input_ids, token_type_ids=token_type_ids)
+        extended_attention_mask = self.roberta.get_extended_attention_mask(
+            attention_mask, input_ids.size(), input_ids.device
+        )
+        exit_classifiers = dict(zip(self.early_exit_layers, self.exit_classifiers))
+
+        logits = None
+        remaining = torch.arange(input_ids.size(0), device=input_ids.device)
+        for layer_number, layer in enumerate(self.roberta.encoder.layer, 1):
+            hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)[0]
+            classifier = exit_classifiers.get(layer_number)
+            if classifier is None or layer_number == len(self.roberta.encoder.layer):
+                continue
+
+            layer_logits = classifier(hidden_states, externalFeatures=externalFeatures)
+            if logits is None:
+                logits = layer_logits.new_empty((input_ids.size(0),) + layer_logits.shape[1:])
+            done = self._confidence(layer_logits) >= self.early_exit_threshold
+            if done.any():
+                logits[remaining[done]] = layer_logits[done]
+                keep = ~done
+                remaining = remaining[keep]
+                if len(remaining) == 0:
+                    return logits
+                hidden_states = hidden_states[keep]
+                extended_attention_mask = extended_attention_mask[keep]
+                if externalFeatures is not None:
+                    externalFeatures = externalFeatures[keep]
+
+        final_logits = self.classifier(hidden_states, externalFeatures=externalFeatures)
+        if logits is None:
+            return final_logits
+        logits[remaining] = final_logits
+        return logits
@@ -1,11 +1,17 @@
+import logging
 import os
+from collections import Counter
 import pandas as pd
 import numpy as np
 from sklearn.metrics import accuracy_score
+from common.lexicalFilter import LexicalFilter
 from model.out_simple_transformer.ClassificationModel import ClassificationModel
 
+logger = logging.getLogger(__name__)
 
-def train_predict_model(df_train, df_test, is_predict, use_cuda, value_head):
+
+def train_predict_model(df_train, df_test, is_predict, use_cuda, value_head, max_tokens_per_batch=None,
+                        early_exit_layers=None):
     df_train = df_train.sample(frac=1)
     labels = list(df_train['labels'].unique())
     labels.sort()
@@ -13,11 +19,13 @@ def train_predict_model(df_train, df_test, is_predict, use_cuda, value_head):
     model = ClassificationModel('roberta', 'roberta-large',
              num_labels=len(labels), use_cuda=use_cuda, args={
             'learning_rate': 1e-5, 'num_train_epochs': 3,
-            'reprocess_input_data': True, 'overwrite_output_dir': True,
+            'reprocess_input_data': False, 'overwrite_output_dir': True,
             'process_count': 10, 'train_batch_size': 4,
             'eval_batch_size': 4, 'max_seq_length': 512,
             'multiprocessing_chunksize': 500, 'fp16': True,
-            'fp16_opt_level': 'O1', 'value_head': value_head})
+            'fp16_opt_level': 'O1', 'value_head': value_head,
+            'use_fast_tokenizer': True, 'max_tokens_per_batch': max_tokens_per_batch,
+            'config': {'early_exit_layers': early_exit_layers} if early_exit_layers else {}})
 
     model.train_model(df_train)
 
@@ -37,14 +45,113 @@ def train_predict_model(df_train, df_test, is_predict, use_cuda, value_head):
     return results, y_predict
 
 
-def predict_task(df_test, use_cuda, model_dir, value_head):
-    model = ClassificationModel(model_type='roberta', model_name=os.getcwd() + model_dir, use_cuda=use_cuda,
-                                args={'value_head': value_head})
+def load_model(model_dir, use_cuda, value_head, **kwargs):
+    args = {'value_head': value_head, 'use_fast_tokenizer': True}
+    args.update(kwargs)
+    return ClassificationModel(model_type='roberta', model_name=os.getcwd() + model_dir, use_cuda=use_cuda,
+                               args=args)
+
+
+def to_predict_list(df_test):
     text_a = df_test['text_a']
     text_b = df_test['text_b']
     feature = df_test['features']
     df_result = pd.concat([text_a, text_b, feature], axis=1)
-    value_in = df_result.values.tolist()
+    return df_result.values.tolist()
+
+
+def predict_task(df_test, use_cuda, model_dir, value_head, max_tokens_per_batch=None):
+    model = load_model(model_dir, use_cuda, value_head, max_tokens_per_batch=max_tokens_per_batch)
+    value_in = to_predict_list(df_test)
     y_predict, model_outputs_test = model.predict(value_in)
     y_predict = np.argmax(model_outputs_test, axis=1)
-    return y_predict
\ No newline at end of file
+    return y_predict
+
+
+class StanceCascade:
+    """
+    Two-stage FNC classifier: the first stage model tells related from unrelated pairs and the second
+    stage model classifies the stance of the related ones. Both models are loaded once. When they
+    tokenize the same way, the test set is tokenized once and the second stage reuses the features
+    of the related pairs; otherwise the related pairs are tokenized again for the second stage.
+
+    With `lexical_threshold`, a LexicalFilter takes the pairs below that TF-IDF similarity as
+    unrelated before the first stage (stage 0). After predict, stage_counts holds the number of
+    pairs decided by each stage.
+
+    predict_chunks predicts a data set chunk by chunk as it is read (see common.loadData.iter_data).
+    """
+
+    def __init__(self, model_dir_1_stage, model_dir_2_stage, use_cuda, value_head_1_stage,
+                 max_tokens_per_batch=None, lexical_threshold=None, early_exit_threshold=None):
+        # Only used by models trained with early_exit_layers
+        config = {'early_exit_threshold': early_exit_threshold} if early_exit_threshold is not None else {}
+        self.model_1_stage = load_model(model_dir_1_stage, use_cuda, value_head_1_stage,
+                                        max_tokens_per_batch=max_tokens_per_batch, config=config)
+        self.model_2_stage = None
+        self.shares_features = False
+        if model_dir_2_stage != '':
+            self.model_2_stage = load_model(model_dir_2_stage, use_cuda, 0, max_tokens_per_batch=max_tokens_per_batch,
+                                            config=config)
+            self.shares_features = self.model_1_stage.shares_features_with(self.model_2_stage)
+            if not self.shares_features:
+                logger.warning("The models of %s and %s tokenize differently, the related pairs will be tokenized "
+                               "again for the second stage", model_dir_1_stage, model_dir_2_stage)
+        self.lexical_filter = LexicalFilter(lexical_threshold) if lexical_threshold is not None else None
+        self.stage_counts = {}
+
+    def predict(self, df_test):
+        """
+        Returns the predicted classes (0 agree, 1 disagree, 2 discuss, 3 unrelated), or only the
+        first stage predictions (0 unrelated, 1 related) without a second stage model.
+        """
+        y_predict = np.full(len(df_test), 3 if self.model_2_stage is not None else 0)
+        rows_1 = np.arange(len(df_test))
+        if self.lexical_filter is not None:
+            rows_1 = np.flatnonzero(~self.lexical_filter.is_unrelated(df_test['text_a'], df_test['text_b']))
+        self.stage_counts = {'stage_0': len(df_test) - len(rows_1), 'stage_1': len(rows_1), 'stage_2': 0}
+        if len(rows_1) == 0:
+            return y_predict
+
+        value_in = to_predict_list(df_test.iloc[rows_1])
+        features = self.model_1_stage.examples_to_features(value_in)
+        y_predict_1 = np.argmax(self.model_1_stage.predict_features(features), axis=1)
+        if self.model_2_stage is None:
+            y_predict[rows_1] = y_predict_1
+            return y_predict
+
+        related = np.flatnonzero(y_predict_1 == 1)
+        self.stage_counts.update({'stage_1': len(rows_1) - len(related), 'stage_2': len(related)})
+        if len(related) > 0:
+            if self.shares_features:
+                # The external features of the first stage are ignored by the second stage head
+                features_2 = features.select(related)
+            else:
+                logger.info("Tokenizing %d related pairs again for the second stage", len(related))
+                features_2 = self.model_2_stage.examples_to_features([value_in[i] for i in related])
+            y_predict[rows_1[related]] = np.argmax(self.model_2_stage.predict_features(features_2), axis=1)
+        return y_predict
+
+    def predict_chunks(self, chunks):
+        """
+        Predicts the frames of `chunks` one at a time and yields (frame, predictions) for each, so a
+        chunk is tokenized and predicted as soon as it is read and the whole data set is never held.
+        The models stay on their device until the chunks are done, and stage_counts then sums the
+        counts of all the chunks. A LexicalFilter that was not fitted fits its weights on each chunk.
+        """
+        models = [model for model in (self.model_1_stage, self.model_2_stage) if model is not None]
+        keep_model_on_device = [model.args.keep_model_on_device for model in models]
+        for model in models:
+            model.args.keep_model_on_device = True
+        stage_counts = Counter()
+        try:
+            for df_chunk in chunks:
+                y_predict = self.predict(df_chunk)
+                stage_counts.update(self.stage_counts)
+                yield df_chunk, y_predict
+        finally:
+            for model, keep in zip(models, keep_model_on_device):
+                model.args.keep_model_on_device = keep
+                if not keep:
+                    model.release()
+            self.stage_counts = dict(stage_counts)
@@ -0,0 +1,80 @@
+import argparse
+import os
+import sys
+import numpy as np
+from common.loadData import load_data
+from model.roberta.roberta_model import load_model, to_predict_list
+
+
+def main(parser):
+    args = parser.parse_args()
+    model_dir = args.model_dir
+    features = args.features
+    output = args.output if args.output != '' else model_dir + '/model.onnx'
+    opset = args.opset
+    test_set = args.test_set
+    sample_size = args.sample_size
+    tolerance = args.tolerance
+
+    model = load_model(model_dir, False, len(features), silent=True)
+    model.export_onnx(os.getcwd() + output, opset_version=opset)
+    print('ONNX model saved to {}'.format(output))
+
+    if test_set != '':
+        # Same raw outputs with the PyTorch model and with the exported graph on a sample of the test set
+        label_map = {'unrelated': 3, 'agree': 0, 'disagree': 1, 'discuss': 2}
+        df_test = load_data(test_set, features, label_map, 'test', '')
+        df_sample = df_test.sample(min(sample_size, len(df_test)), random_state=0)
+        sample_features = model.examples_to_features(to_predict_list(df_sample))
+
+        outputs_torch = model.predict_features(sample_features)
+        model.args.onnx_model_path = os.getcwd() + output
+        outputs_onnx = model.predict_features(sample_features)
+
+        max_diff = np.abs(outputs_torch - outputs_onnx).max()
+        agreement = np.mean(np.argmax(outputs_torch, axis=1) == np.argmax(outputs_onnx, axis=1))
+        print('Max abs difference of the outputs: {:.6g}, same predictions: {:.2%}'.format(max_diff, agreement))
+        if max_diff > tolerance:
+            sys.exit('The outputs of the ONNX model differ by more than {}'.format(tolerance))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    ## Required parameters
+
+    parser.add_argument("--model_dir",
+                        default="",
+                        type=str,
+                        help="This parameter is the relative dir of the model to export.")
+
+    parser.add_argument("--features",
+                        default=[],
+                        nargs='+',
+                        help="This parameter is features of the model to export.")
+
+    parser.add_argument("--output",
+                        default="",
+                        type=str,
+                        help="This parameter is the relative path of the ONNX model, model.onnx in the model dir by default.")
+
+    parser.add_argument("--opset",
+                        default=14,
+                        type=int,
+                        help="This parameter is the ONNX opset version of the exported model.")
+
+    parser.add_argument("--test_set",
+                        default="",
+                        type=str,
+                        help="This parameter is the relative dir of the test set used to check the exported model.")
+
+    parser.add_argument("--sample_size",
+                        default=256,
+                        type=int,
+                        help="This parameter is the number of test pairs on which the outputs are compared.")
+
+    parser.add_argument("--tolerance",
+                        default=1e-3,
+                        type=float,
+                        help="This parameter is the maximum abs difference allowed between the PyTorch and ONNX outputs.")
+
+    main(parser)
@@ -1,7 +1,7 @@
 import argparse
-from common.loadData import load_data
-from model.roberta.roberta_model import predict_task
-import pandas as pd
+import numpy as np
+from common.loadData import iter_data, load_data
+from model.roberta.roberta_model import StanceCascade
 from common.score import scorePredict
 
 
@@ -9,36 +9,41 @@ def main(parser):
     args = parser.parse_args()
     test_set = args.test_set
     use_cuda = args.use_cuda
+    columnar_cache = args.columnar_cache
+    max_tokens_per_batch = args.max_tokens_per_batch
+    lexical_threshold = args.lexical_threshold
+    early_exit_threshold = args.early_exit_threshold
+    chunk_size = args.chunk_size
     model_dir_1_stage = args.model_dir_1_stage
     model_dir_2_stage = args.model_dir_2_stage
     features_1_stage = args.features_1_stage
 
 
     label_map = {'unrelated': 3, 'agree': 0, 'disagree': 1, 'discuss': 2}
-    df_test = load_data(test_set, features_1_stage, label_map, 'test', '')
+    if lexical_threshold is None:
+        # Each chunk is predicted as soon as it is read
+        chunks = iter_data(test_set, features_1_stage, label_map, 'test', '', chunk_size=chunk_size,
+                           columnar_cache=columnar_cache)
+    else:
+        # The TF-IDF weights of the lexical filter are fitted on the whole test set
+        chunks = [load_data(test_set, features_1_stage, label_map, 'test', '', columnar_cache=columnar_cache)]
 
     if model_dir_1_stage != '':
-        y_predict_1 = predict_task(df_test, use_cuda, model_dir_1_stage, len(features_1_stage))
-        df_result = df_test
-        df_result['predict'] = y_predict_1
-        if model_dir_2_stage != '':
-            df_y_1 = pd.DataFrame(y_predict_1, columns=['predict'])
-            df_y_1_0 = df_y_1[df_y_1['predict'] == 0]
-            df_y_1_1 = df_y_1[df_y_1['predict'] == 1]
+        cascade = StanceCascade(model_dir_1_stage, model_dir_2_stage, use_cuda, len(features_1_stage),
+                                max_tokens_per_batch=max_tokens_per_batch, lexical_threshold=lexical_threshold,
+                                early_exit_threshold=early_exit_threshold)
+        y_test = []
+        y_predict = []
+        for df_chunk, y_predict_chunk in cascade.predict_chunks(chunks):
+            y_test.append(df_chunk['labels'].to_numpy())
+            y_predict.append(y_predict_chunk)
+        y_test = np.concatenate(y_test)
+        y_predict = np.concatenate(y_predict)
+        print('Pairs decided by each stage: {}'.format(cascade.stage_counts))
 
-            p_test_1 = df_test.loc[df_y_1_0.index]
-            p_test_1['predict'] = df_y_1_0['predict'].values
-            p_test_1['predict'] = p_test_1['predict'].replace(0, 3)
-
-            df_test_2 = df_test.loc[df_y_1_1.index]
-            y_predict_2 = predict_task(df_test_2, use_cuda, model_dir_2_stage, 0)
-            df_test_2['predict'] = y_predict_2
-            df_result = pd.concat([p_test_1, df_test_2], axis=0)
-
-    labels = list(df_test['labels'].unique())
-    labels.sort()
-    result, f1 = scorePredict(df_result['predict'].values, df_result['labels'].values, labels)
-    print(result)
+        labels = sorted(np.unique(y_test).tolist())
+        result, f1 = scorePredict(y_predict, y_test, labels)
+        print(result)
 
 
 
@@ -72,4 +77,29 @@ if __name__ == '__main__':
                         nargs='+',
                         help="This parameter is features of model first stage for predict.")
 
+    parser.add_argument("--columnar_cache",
+                        default=False,
+                        action='store_true',
+                        help="This parameter converts the data sets once to Arrow files that are memory mapped on next runs.")
+
+    parser.add_argument("--max_tokens_per_batch",
+                        default=None,
+                        type=int,
+                        help="This parameter forms the batches by their number of padded tokens instead of by a fixed number of examples.")
+
+    parser.add_argument("--lexical_threshold",
+                        default=None,
+                        type=float,
+                        help="This parameter takes the pairs with a lower TF-IDF similarity between headline and body as unrelated without running the models.")
+
+    parser.add_argument("--early_exit_threshold",
+                        default=None,
+                        type=float,
+                        help="This parameter stops the models trained with early exit layers at the first exit layer whose confidence reaches it.")
+
+    parser.add_argument("--chunk_size",
+                        default=10000,
+                        type=int,
+                        help="This parameter is the number of pairs read and predicted at a time.")
+
     main(parser)
\ No newline at end of file
@@ -0,0 +1,139 @@
+import argparse
+import os
+import time
+import numpy as np
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static
+from sklearn.metrics import accuracy_score, f1_score
+from common.loadData import load_data
+from model.roberta.roberta_model import load_model, to_predict_list
+
+
+class FeatureCalibrationReader(CalibrationDataReader):
+    """Feeds the prediction batches of a calibration sample to the ONNX Runtime calibration."""
+
+    def __init__(self, model, features, input_names):
+        self.model = model
+        self.features = features
+        self.input_names = input_names
+        self.batches = None
+
+    def get_next(self):
+        if self.batches is None:
+            self.batches = self.model.onnx_inputs(self.features, self.input_names)
+        return next(self.batches, None)
+
+    def rewind(self):
+        self.batches = None
+
+
+def evaluate(model, features, labels):
+    start = time.perf_counter()
+    y_predict = np.argmax(model.predict_features(features), axis=1)
+    seconds = time.perf_counter() - start
+    return {'accuracy': accuracy_score(labels, y_predict), 'f1_macro': f1_score(labels, y_predict, average='macro'),
+            'ms_per_pair': seconds * 1000 / len(labels)}
+
+
+def main(parser):
+    args = parser.parse_args()
+    training_set = args.training_set
+    test_set = args.test_set
+    model_dir = args.model_dir
+    type_classify = args.type_classify
+    features_1_stage = args.features_1_stage
+    calibration_size = args.calibration_size
+    calibration_method = args.calibration_method
+    per_channel = args.per_channel
+    columnar_cache = args.columnar_cache
+
+    features = features_1_stage
+    if type_classify == 'related':
+        label_map = {'unrelated': 0, 'agree': 1, 'disagree': 1, 'discuss': 1}
+    elif type_classify == 'stance':
+        label_map = {'agree': 0, 'disagree': 1, 'discuss': 2}
+        features = []
+    else:
+        label_map = {'unrelated': 3, 'agree': 0, 'disagree': 1, 'discuss': 2}
+
+    fp32_path = os.getcwd() + model_dir + '/model.onnx'
+    int8_path = os.getcwd() + model_dir + '/model.int8.onnx'
+    model = load_model(model_dir, False, len(features), silent=True)
+    if not os.path.exists(fp32_path):
+        model.export_onnx(fp32_path)
+    input_names = ['input_ids', 'attention_mask'] + (['externalFeatures'] if features else [])
+
+    # Activation ranges are calibrated on a sample of the training set
+    df_train = load_data(training_set, features, label_map, 'training', type_classify, columnar_cache=columnar_cache)
+    df_calibration = df_train.sample(min(calibration_size, len(df_train)), random_state=0)
+    calibration_features = model.examples_to_features(to_predict_list(df_calibration))
+    quantize_static(fp32_path, int8_path, FeatureCalibrationReader(model, calibration_features, input_names),
+                    quant_format=QuantFormat.QDQ, activation_type=QuantType.QInt8, weight_type=QuantType.QInt8,
+                    per_channel=per_channel, calibrate_method=CalibrationMethod[calibration_method])
+    print('Quantized model saved to {}'.format(model_dir + '/model.int8.onnx'))
+
+    df_test = load_data(test_set, features, label_map, 'test', type_classify, columnar_cache=columnar_cache)
+    test_features = model.examples_to_features(to_predict_list(df_test))
+    labels = df_test['labels'].to_numpy()
+
+    print('|Model|Size (MB)|Accuracy|F1 macro|ms per pair|')
+    print('|---|---|---|---|---|')
+    # The ONNX backend does not use the PyTorch weights, so the loaded model only switches backends
+    pytorch_size = sum(parameter.numel() * parameter.element_size() for parameter in model.model.parameters())
+    for name, path in [('fp32 PyTorch', None), ('fp32 ONNX', fp32_path), ('int8 ONNX', int8_path)]:
+        model.use_onnx_model(path)
+        report = evaluate(model, test_features, labels)
+        size = os.path.getsize(path) if path is not None else pytorch_size
+        print('|{}|{:.1f}|{:.5f}|{:.5f}|{:.2f}|'.format(name, size / 2 ** 20, report['accuracy'], report['f1_macro'],
+                                                    report['ms_per_pair']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    ## Required parameters
+
+    parser.add_argument("--type_classify",
+                        default="",
+                        type=str,
+                        help="This parameter is used for choose type of classify.")
+
+    parser.add_argument("--training_set",
+                        default="/data/FNC_PLM_originDataset_train_all_summary_v2.json",
+                        type=str,
+                        help="This parameter is the relative dir of training set, from which the calibration sample is taken.")
+
+    parser.add_argument("--test_set",
+                        default="/data/FNC_PLM_originDataset_test_all_summary_v2.json",
+                        type=str,
+                        help="This parameter is the relative dir of test set.")
+
+    parser.add_argument("--model_dir",
+                        default="",
+                        type=str,
+                        help="This parameter is the relative dir of the model to quantize.")
+
+    parser.add_argument("--features_1_stage",
+                        default=[],
+                        nargs='+',
+                        help="This parameter is features of model first stage.")
+
+    parser.add_argument("--calibration_size",
+                        default=512,
+                        type=int,
+                        help="This parameter is the number of training pairs used to calibrate the activations.")
+
+    parser.add_argument("--calibration_method",
+                        default="MinMax",
+                        choices=["MinMax", "Entropy", "Percentile"],
+                        help="This parameter is the method computing the ranges of the activations.")
+
+    parser.add_argument("--per_channel",
+                        default=False,
+                        action='store_true',
+                        help="This parameter quantizes the weights with a scale per output channel.")
+
+    parser.add_argument("--columnar_cache",
+                        default=False,
+                        action='store_true',
+                        help="This parameter converts the data sets once to Arrow files that are memory mapped on next runs.")
+
+    main(parser)
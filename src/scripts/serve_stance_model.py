@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+import numpy as np
+from model.out_simple_transformer.MicroBatchPredictor import MicroBatchPredictor
+from model.roberta.roberta_model import load_model
+
+LABELS = {0: 'agree', 1: 'disagree', 2: 'discuss', 3: 'unrelated'}
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class LatencyStats:
+    """Latencies in milliseconds of the last `size` requests of each stage."""
+
+    def __init__(self, stages, size=10000):
+        self.latencies = {stage: deque(maxlen=size) for stage in stages}
+        self.counts = {stage: 0 for stage in stages}
+
+    def add(self, stage, seconds):
+        self.latencies[stage].append(seconds * 1000)
+        self.counts[stage] += 1
+
+    def report(self):
+        report = {}
+        for stage, latencies in self.latencies.items():
+            report[stage] = {'count': self.counts[stage]}
+            if latencies:
+                p50, p90, p99 = np.percentile(np.fromiter(latencies, dtype=np.float64), [50, 90, 99])
+                report[stage].update({'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'max_ms': max(latencies)})
+        return report
+
+
+class StanceService:
+    """Two-stage FNC pipeline: stage 1 tells related from unrelated pairs, stage 2 classifies the stance of related ones."""
+
+    def __init__(self, predictor_1_stage, predictor_2_stage, features_1_stage):
+        self.predictor_1_stage = predictor_1_stage
+        self.predictor_2_stage = predictor_2_stage
+        self.features_1_stage = features_1_stage
+        self.stats = LatencyStats(['stage_1', 'stage_2', 'total'])
+
+    def parse_pair(self, pair):
+        # Same fields and body layout as the records of the data sets (see common.loadData)
+        headline = pair['sentence1']
+        sentences = pair['sentences2']
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        body = ' '.join(sentences) + ' ' if len(sentences) > 0 else ''
+        features = [float(pair[name]) for name in self.features_1_stage] if self.features_1_stage else 0
+        return headline, body, features
+
+    async def predict(self, pair):
+        headline, body, features = self.parse_pair(pair)
+        start = time.perf_counter()
+        outputs_1 = await asyncio.wrap_future(self.predictor_1_stage.submit(headline, body, features))
+        end_1 = time.perf_counter()
+        self.stats.add('stage_1', end_1 - start)
+
+        if np.argmax(outputs_1) == 0:
+            result = {'stage': 1, 'label': LABELS[3]}
+        elif self.predictor_2_stage is None:
+            result = {'stage': 1, 'label': 'related'}
+        else:
+            outputs_2 = await asyncio.wrap_future(self.predictor_2_stage.submit(headline, body, 0))
+            self.stats.add('stage_2', time.perf_counter() - end_1)
+            result = {'stage': 2, 'label': LABELS[int(np.argmax(outputs_2))]}
+
+        self.stats.add('total', time.perf_counter() - start)
+        return result
+
+    async def handle(self, method, path, body):
+        if path == '/stats':
+            if method != 'GET':
+                return 405, {'error': 'Use GET'}
+            return 200, self.stats.report()
+        if path != '/predict':
+            return 404, {'error': 'Unknown path {}'.format(path)}
+        if method != 'POST':
+            return 405, {'error': 'Use POST'}
+
+        try:
+            request = json.loads(body)
+            if isinstance(request, list):
+                return 200, list(await asyncio.gather(*[self.predict(pair) for pair in request]))
+            return 200, await self.predict(request)
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                try:
+                    status, response = await self.handle(method, path.split('?')[0], body)
+                except Exception as e:
+                    status, response = 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                payload = json.dumps(response).encode('utf-8')
+                writer.write(('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                              'Connection: {}\r\n\r\n').format(status, REASONS[status], len(payload),
+                                                               'keep-alive' if keep_alive else 'close')
+                             .encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service, host, port):
+    server = await asyncio.start_server(service.serve_connection, host, port)
+    print('Serving on http://{}:{} (POST /predict, GET /stats)'.format(host, port))
+    async with server:
+        await server.serve_forever()
+
+
+def main(parser):
+    args = parser.parse_args()
+    features_1_stage = args.features_1_stage
+
+    model_1_stage = load_model(args.model_dir_1_stage, args.use_cuda, len(features_1_stage), silent=True)
+    predictor_1_stage = MicroBatchPredictor(model_1_stage, args.max_batch_size, args.max_wait)
+    predictor_2_stage = None
+    if args.model_dir_2_stage != '':
+        model_2_stage = load_model(args.model_dir_2_stage, args.use_cuda, 0, silent=True)
+        predictor_2_stage = MicroBatchPredictor(model_2_stage, args.max_batch_size, args.max_wait)
+
+    service = StanceService(predictor_1_stage, predictor_2_stage, features_1_stage)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        predictor_1_stage.close()
+        if predictor_2_stage is not None:
+            predictor_2_stage.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    ## Required parameters
+
+    parser.add_argument("--use_cuda",
+                        default=False,
+                        action='store_true',
+                        help="This parameter should be True if cuda is present.")
+
+    parser.add_argument("--model_dir_1_stage",
+                        default="",
+                        type=str,
+                        help="This parameter is the relative dir of the model first stage to predict.")
+
+    parser.add_argument("--model_dir_2_stage",
+                        default="",
+                        type=str,
+                        help="This parameter is the relative dir of the model second stage to predict.")
+
+    parser.add_argument("--features_1_stage",
+                        default=[],
+                        nargs='+',
+                        help="This parameter is features of model first stage for predict.")
+
+    parser.add_argument("--host",
+                        default="127.0.0.1",
+                        type=str,
+                        help="This parameter is the address the server listens on.")
+
+    parser.add_argument("--port",
+                        default=8000,
+                        type=int,
+                        help="This parameter is the port the server listens on.")
+
+    parser.add_argument("--max_batch_size",
+                        default=32,
+                        type=int,
+                        help="This parameter is the maximum number of requests predicted together by each model.")
+
+    parser.add_argument("--max_wait",
+                        default=0.005,
+                        type=float,
+                        help="This parameter is the maximum time in seconds a request waits for others to fill a batch.")
+
+    main(parser)
@@ -10,6 +10,9 @@ def main(parser):
     training_set = args.training_set
     test_set = args.test_set
     use_cuda = args.use_cuda
+    columnar_cache = args.columnar_cache
+    max_tokens_per_batch = args.max_tokens_per_batch
+    early_exit_layers = args.early_exit_layers
     model_dir = args.model_dir
     type_classify = args.type_classify
     features_1_stage = args.features_1_stage
@@ -23,13 +26,16 @@ def main(parser):
     else:
         label_map = {'unrelated': 3, 'agree': 0, 'disagree': 1, 'discuss': 2}
 
-    df_train = load_data(training_set, features, label_map, 'training', type_classify)
-    df_test = load_data(test_set, features, label_map, 'test', type_classify)
+    df_train = load_data(training_set, features, label_map, 'training', type_classify,
+                         columnar_cache=columnar_cache)
+    df_test = load_data(test_set, features, label_map, 'test', type_classify, columnar_cache=columnar_cache)
 
     if model_dir == '':
-        _, y_predict = train_predict_model(df_train, df_test, True, use_cuda, len(features))
+        _, y_predict = train_predict_model(df_train, df_test, True, use_cuda, len(features),
+                                           max_tokens_per_batch=max_tokens_per_batch,
+                                           early_exit_layers=early_exit_layers)
     else:
-        y_predict = predict_task(df_test, use_cuda, model_dir, len(features))
+        y_predict = predict_task(df_test, use_cuda, model_dir, len(features), max_tokens_per_batch=max_tokens_per_batch)
 
     labels_test = pd.Series(df_test['labels']).to_numpy()
     labels = list(df_test['labels'].unique())
@@ -72,4 +78,20 @@ if __name__ == '__main__':
                         nargs='+',
                         help="This parameter is the features of model first stage for predict.")
 
+    parser.add_argument("--columnar_cache",
+                        default=False,
+                        action='store_true',
+                        help="This parameter converts the data sets once to Arrow files that are memory mapped on next runs.")
+
+    parser.add_argument("--max_tokens_per_batch",
+                        default=None,
+                        type=int,
+                        help="This parameter forms the batches by their number of padded tokens instead of by a fixed number of examples.")
+
+    parser.add_argument("--early_exit_layers",
+                        default=None,
+                        type=int,
+                        nargs='+',
+                        help="This parameter trains a classification head after each of these encoder layers for early exit.")
+
     main(parser)
\ No newline at end of file